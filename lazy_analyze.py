@@ -1,11 +1,46 @@
 import ast
+import fnmatch
 import importlib.util
+import json
+import os
 import sys
-import tokenize
+from collections import deque
+import lazy_cache
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
 
 class OPTIONS:
     verbose = 0
     allow_bases = True
+    # directory of the persistent result cache, shared with lazy_compile
+    cache_dir = os.environ.get('LAZY_COMPILE_CACHE')
+    # fnmatch patterns of the (dotted) names that are safe to call, use
+    # as decorators or subscript, given safe arguments.  The names are
+    # assumed to mean what they usually do.
+    pure_names = [
+        'staticmethod', 'classmethod', 'property', '*.setter',
+        '*.getter', '*.deleter',
+        'tuple', 'list', 'dict', 'set', 'frozenset', 'type',
+        'functools.wraps', 'functools.partial', 'functools.lru_cache',
+        'functools.cache', 'functools.cached_property',
+        'functools.total_ordering',
+        'abc.abstractmethod', 'abstractmethod', 'abc.ABCMeta', 'ABCMeta',
+        'dataclass', 'dataclasses.dataclass', 'dataclasses.field',
+        'collections.namedtuple', 'namedtuple',
+        'typing.*', 'TypeVar', 'Optional', 'Union', 'List', 'Dict',
+        'Tuple', 'Set', 'FrozenSet', 'Callable', 'Type', 'ClassVar',
+        'Iterable', 'Iterator', 'Sequence', 'Mapping',
+        're.compile',
+        ]
+
+# the options that change analysis results
+RESULT_OPTIONS = ('allow_bases', 'pure_names')
+# files handed to a worker process at a time, and the number of batches
+# in flight per worker
+WORKER_BATCH = 32
+WORKER_QUEUE = 4
 
 
 class Analyzer(ast.NodeVisitor):
@@ -48,11 +83,7 @@ class Analyzer(ast.NodeVisitor):
         'Try',
         'Assert',
         'BoolOp',
-        'BinOp',
-        'UnaryOp',
-        'Lambda', # FIXE, could be safe
         'AugAssign',
-        'AnnAssign',
         # maybe safe
         'For',
         'AsyncWith',
@@ -64,11 +95,8 @@ class Analyzer(ast.NodeVisitor):
         'Yield',
         'YieldFrom',
         'Compare',
-        'Call',
         'FormattedValue',
         'JoinedStr',
-        'Attribute',
-        'Subscript',
         'Starred',
         'Slice',
         'ExtSlice',
@@ -105,11 +133,17 @@ class Analyzer(ast.NodeVisitor):
         'comprehension',
         }
 
-    def __init__(self, fn, *args, **kwargs):
+    def __init__(self, fn, *args, future_annotations=False, **kwargs):
         ast.NodeVisitor.__init__(self, *args, **kwargs)
         self.fn = fn
+        # with 'from __future__ import annotations' they are not run
+        self.future_annotations = future_annotations
         self.imports = []
+        # dotted names are fine in annotations, see visit_Attribute()
+        self.in_annotation = False
         self.safe = True
+        # (lineno, message) for each unsafe node found
+        self.notes = []
 
     def analyze(self, node):
         self.visit(node)
@@ -126,18 +160,13 @@ class Analyzer(ast.NodeVisitor):
         elif name in self.UNSAFE:
             self.note_unsafe('unsafe', node)
         else:
-            raise RuntimeError(f'unknown node {name}')
+            # e.g. syntax newer than this list, keep it eager
+            self.note_unsafe('unknown', node)
 
     def note_unsafe(self, msg, node):
-        if not self.safe and OPTIONS.verbose <= 1:
-            return # only print first warning
         self.safe = False
-        if hasattr(node, 'lineno'):
-            lineno = node.lineno
-        else:
-            lineno = '???'
-        if OPTIONS.verbose:
-            print(f'{self.fn}:{lineno}: {msg} {node.__class__.__name__}')
+        lineno = getattr(node, 'lineno', None)
+        self.notes.append((lineno, f'{msg} {node.__class__.__name__}'))
 
     def visit_Assign(self, node):
         # Assignments are safe if the RHS doesn't have side effects
@@ -162,27 +191,213 @@ class Analyzer(ast.NodeVisitor):
         # E.g. could raise error, cause getattr hook to run.
         self.imports.append(node.module)
 
+    def visit_Call(self, node):
+        name = dotted_name(node.func)
+        if name is None or not is_pure_name(name):
+            self.note_unsafe(f'call of {name or "?"}', node)
+            return
+        if name in CONTAINER_CALLS:
+            for arg in node.args + [keyword.value for keyword in
+                                    node.keywords]:
+                try:
+                    literal_value(arg)
+                except (ValueError, TypeError, SyntaxError, RecursionError):
+                    self.note_unsafe(f'call of {name} on a variable', node)
+                    return
+        for arg in node.args:
+            self.visit(arg)
+        for keyword in node.keywords:
+            self.visit(keyword.value)
+
+    def visit_Attribute(self, node):
+        # Looking up a.b.c to call it, decorate or subscript with it,
+        # annotate or as a base is fine, other attributes could be
+        # anything.  Its value is a different matter, a.b may change
+        # before it is woken, e.g. sys.stdout.
+        name = dotted_name(node)
+        if (not isinstance(node.ctx, ast.Load) or name is None or
+                not self.in_annotation):
+            self.note_unsafe(f'value of {name or "?"}', node)
+
+    def visit_Subscript(self, node):
+        # e.g. List[int] in annotations
+        name = dotted_name(node.value)
+        if (not isinstance(node.ctx, ast.Load) or name is None or
+                not is_pure_name(name)):
+            self.note_unsafe(f'subscript of {name or "?"}', node)
+            return
+        self.visit(node.slice)
+
+    def visit_BinOp(self, node):
+        if not is_constant_expr(node):
+            self.note_unsafe('unsafe', node)
+
+    visit_UnaryOp = visit_BinOp
+
+    def visit_Lambda(self, node):
+        # the body runs when called
+        self._visit_defaults(node.args)
+
+    def visit_AnnAssign(self, node):
+        self.visit(node.target)
+        self._visit_annotation(node.annotation)
+        if node.value is not None:
+            self.visit(node.value)
+
+    def _visit_defaults(self, args):
+        for v in args.defaults + args.kw_defaults:
+            self.visit(v)
+
+    def _visit_annotation(self, node):
+        if node is None or self.future_annotations:
+            return
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.BitOr):
+            # int | None
+            self._visit_annotation(node.left)
+            self._visit_annotation(node.right)
+        else:
+            self.in_annotation = True
+            try:
+                self.visit(node)
+            finally:
+                self.in_annotation = False
+
+    def _visit_decorators(self, node):
+        for decorator in node.decorator_list:
+            # @name is a call of name
+            if isinstance(decorator, ast.Call):
+                self.visit(decorator)
+            else:
+                name = dotted_name(decorator)
+                if name is None or not is_pure_name(name):
+                    self.note_unsafe(f'decorator {name or "?"}', node)
+
     def visit_ClassDef(self, node):
-        # bases, body, decorator_list, keywords (empty)
+        # bases, body, decorator_list, keywords
+        self._visit_decorators(node)
+        for keyword in node.keywords:
+            # metaclass or __init_subclass__ arguments
+            name = dotted_name(keyword.value)
+            if (keyword.arg != 'metaclass' or name is None or
+                    not is_pure_name(name)):
+                self.note_unsafe('class keywords', node)
         if node.bases:
             if not OPTIONS.allow_bases:
                 self.note_unsafe('base classes', node)
                 return
+            for base in node.bases:
+                if isinstance(base, ast.Attribute) and dotted_name(base):
+                    # mod.Base
+                    continue
+                self.visit(base)
         for stmt in node.body:
             self.visit(stmt)
 
     def visit_FunctionDef(self, node):
         # args, body, decorator_list, returns
-        if node.decorator_list:
-            self.note_unsafe('decorator', node)
-        for v in node.args.kw_defaults:
-            self.visit(v)
-        # FIXME: type annotations?
+        self._visit_decorators(node)
+        self._visit_defaults(node.args)
+        args = node.args
+        for arg in (args.posonlyargs + args.args + args.kwonlyargs +
+                    [args.vararg, args.kwarg]):
+            if arg is not None:
+                self._visit_annotation(arg.annotation)
+        self._visit_annotation(node.returns)
 
     def visit_AsyncFunctionDef(self, node):
         self.visit_FunctionDef(node)
 
 
+def dotted_name(node):
+    # 'a.b.c' for a chain of attribute lookups on a name, else None
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        base = dotted_name(node.value)
+        if base is not None:
+            return base + '.' + node.attr
+    return None
+
+
+def is_pure_name(name):
+    return any(fnmatch.fnmatchcase(name, pattern)
+               for pattern in OPTIONS.pure_names)
+
+
+def is_constant_expr(node):
+    # operators on literals only, e.g. 1 << 20 or -1
+    if isinstance(node, ast.Constant):
+        return True
+    if isinstance(node, ast.BinOp):
+        return is_constant_expr(node.left) and is_constant_expr(node.right)
+    if isinstance(node, ast.UnaryOp):
+        return is_constant_expr(node.operand)
+    if isinstance(node, ast.Tuple):
+        return all(is_constant_expr(elt) for elt in node.elts)
+    return False
+
+
+# calls that copy their argument, only pure on literals: deferring
+# tuple(registry) would see what was added to it since
+CONTAINER_CALLS = {'tuple', 'list', 'dict', 'set', 'frozenset'}
+
+# calls that build a constant from a literal, like the compiler does
+# for 'x in {...}'
+LITERAL_CALLS = {'frozenset': frozenset, 'tuple': tuple}
+
+
+def literal_value(node):
+    # The value of 'node' if it is a literal: constants, containers of
+    # literals and frozenset() or tuple() of one.  Raises ValueError if
+    # it is not.
+    if isinstance(node, ast.Call):
+        if (isinstance(node.func, ast.Name) and
+                node.func.id in LITERAL_CALLS and
+                is_pure_name(node.func.id) and
+                len(node.args) <= 1 and not node.keywords):
+            args = [literal_value(arg) for arg in node.args]
+            try:
+                return LITERAL_CALLS[node.func.id](*args)
+            except TypeError as e:
+                raise ValueError(str(e)) from None
+        raise ValueError('not a literal')
+    if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+        elts = [literal_value(elt) for elt in node.elts]
+        try:
+            if isinstance(node, ast.Tuple):
+                return tuple(elts)
+            if isinstance(node, ast.List):
+                return elts
+            return set(elts)
+        except TypeError as e:
+            raise ValueError(str(e)) from None
+    if isinstance(node, ast.Dict):
+        if None in node.keys:
+            raise ValueError('dict unpacking')
+        try:
+            return {literal_value(k): literal_value(v)
+                    for k, v in zip(node.keys, node.values)}
+        except TypeError as e:
+            raise ValueError(str(e)) from None
+    # constants and +/- on numbers, which ast.literal_eval folds safely
+    return ast.literal_eval(node)
+
+
+def future_flags(node):
+    # (compiler flags, names) of the __future__ imports of module 'node'
+    import __future__
+    flags = 0
+    names = set()
+    for stmt in node.body:
+        if isinstance(stmt, ast.ImportFrom) and stmt.module == '__future__':
+            for alias in stmt.names:
+                feature = getattr(__future__, alias.name, None)
+                if feature is not None:
+                    flags |= feature.compiler_flag
+                    names.add(alias.name)
+    return flags, names
+
+
 def parse(buf, filename='<string>'):
     if isinstance(buf, bytes):
         buf = importlib.util.decode_source(buf)
@@ -199,14 +414,356 @@ def analyze(node, fn):
     t.analyze(node)
     return t
 
-def is_lazy_safe(node):
+def is_lazy_safe(node, future_annotations=False):
     fn = None
-    t = Analyzer(fn)
+    t = Analyzer(fn, future_annotations=future_annotations)
     t.analyze(node)
     return t.safe
 
 
-USAGE = "Usage: %prog [-v] file [...]"
+def statement_verdicts(node, fn=None):
+    # [lineno, name, safe, notes] for each top-level definition in
+    # module 'node' that could be lazy, notes as in Analyzer.notes
+    future = 'annotations' in future_flags(node)[1]
+    result = []
+    for stmt in node.body:
+        if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef)):
+            name = stmt.name
+        elif (isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and
+                isinstance(stmt.targets[0], ast.Name)):
+            name = stmt.targets[0].id
+        else:
+            continue
+        t = Analyzer(fn, future_annotations=future)
+        t.analyze(stmt)
+        result.append([stmt.lineno, name, t.safe, t.notes])
+    return result
+
+
+def deferrable_imports(body, used=(), loaded=()):
+    # (stmt, module, name) for the 'import' statements in module 'body'
+    # that can bind a module whose execution is deferred.  'import a.b'
+    # binds the package 'a', so only 'import a' and 'import a.b as c'
+    # qualify.  Names in 'used' are needed at import time anyway, as
+    # are modules also imported from.  Names not in 'loaded', those the
+    # module's code never looks up, are imported for their side effects
+    # and must run too.
+    imported_from = {stmt.module for stmt in body
+                     if isinstance(stmt, ast.ImportFrom) and not stmt.level}
+    result = []
+    for stmt in body:
+        if not isinstance(stmt, ast.Import):
+            continue
+        modules = analyze(stmt, None).imports
+        for module, alias in zip(modules, stmt.names):
+            name = alias.asname or module
+            if ('.' in name or name in used or name not in loaded or
+                    module in imported_from):
+                continue
+            result.append((stmt, module, name))
+    return result
+
+
+# Startup cost of a module with no measurements, in microseconds: a
+# fixed cost for finding and loading it plus some per byte of source.
+MODULE_COST_US = 30
+BYTE_COST_US = 0.02
+
+
+def _type_checking(node):
+    # 'if TYPE_CHECKING:' blocks don't run
+    test = node.test
+    if isinstance(test, ast.Attribute):
+        test = test.attr
+    elif isinstance(test, ast.Name):
+        test = test.id
+    return test == 'TYPE_CHECKING'
+
+
+def _import_nodes(node):
+    # the import statements run when module 'node' is imported, those in
+    # function bodies don't count
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                              ast.Lambda)):
+            continue
+        if isinstance(child, (ast.Import, ast.ImportFrom)):
+            yield child
+        elif isinstance(child, ast.If) and _type_checking(child):
+            yield from _import_nodes(ast.Module(body=child.orelse,
+                                                type_ignores=[]))
+        else:
+            yield from _import_nodes(child)
+
+
+def module_imports(node, modname, is_package=False, known=()):
+    # The modules importing 'modname' imports, 'node' is its AST.
+    # Relative imports are resolved against its package, 'from p import
+    # m' imports module p.m if it is in 'known'.  Importing a.b.c also
+    # imports a and a.b.
+    package = modname if is_package else modname.rpartition('.')[0]
+    result = set()
+    for imp in _import_nodes(node):
+        if isinstance(imp, ast.Import):
+            names = [alias.name for alias in imp.names]
+        else:
+            target = imp.module
+            if imp.level:
+                parts = package.split('.') if package else []
+                if imp.level - 1 >= len(parts):
+                    continue # beyond the top level package
+                base = '.'.join(parts[:len(parts) - imp.level + 1])
+                target = base + '.' + target if target else base
+            names = [target]
+            for alias in imp.names:
+                if target + '.' + alias.name in known:
+                    names.append(target + '.' + alias.name)
+        for name in names:
+            parts = name.split('.')
+            for i in range(1, len(parts) + 1):
+                result.add('.'.join(parts[:i]))
+    # a submodule needs its package
+    if '.' in modname:
+        result.add(modname.rpartition('.')[0])
+    result.discard(modname)
+    return result
+
+
+def _iter_modules(root):
+    # (module name, path, is package) for the sources under 'root', a
+    # directory on sys.path or a single file
+    if os.path.isfile(root):
+        name = os.path.splitext(os.path.basename(root))[0]
+        yield name, root, False
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        parts = [] if rel == '.' else rel.split(os.sep)
+        if parts and '__init__.py' not in filenames:
+            dirnames[:] = []
+            continue
+        dirnames.sort()
+        for fn in sorted(filenames):
+            if not fn.endswith('.py'):
+                continue
+            if fn == '__init__.py':
+                if parts:
+                    yield '.'.join(parts), os.path.join(dirpath, fn), True
+            else:
+                name = '.'.join(parts + [fn[:-3]])
+                yield name, os.path.join(dirpath, fn), False
+
+
+def build_graph(roots):
+    # ({module: imported modules}, {module: estimated cost in us}) for
+    # the sources under 'roots'
+    modules = {}
+    for root in roots:
+        for name, path, is_package in _iter_modules(root):
+            modules.setdefault(name, (path, is_package))
+    graph = {}
+    cost = {}
+    for name, (path, is_package) in modules.items():
+        try:
+            with open(path, 'rb') as fp:
+                buf = fp.read()
+            node = parse(buf, path)
+        except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+            continue
+        graph[name] = module_imports(node, name, is_package, modules)
+        cost[name] = MODULE_COST_US + len(buf) * BYTE_COST_US
+    return graph, cost
+
+
+def read_importtime(path, graph=None):
+    # Self cost in us per module from 'python -X importtime' output.  The
+    # nesting there shows what imported what, that is added to 'graph'.
+    cost = {}
+    pending = {}
+    with open(path) as fp:
+        for line in fp:
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            name = name.strip()
+            cost[name] = cost.get(name, 0) + int(fields[0])
+            # imports are listed before the module importing them
+            children = pending.pop(depth + 1, ())
+            pending.setdefault(depth, []).append(name)
+            if graph is not None:
+                graph.setdefault(name, set()).update(children)
+    return cost
+
+
+def dominators(graph, entry):
+    # ({module: immediate dominator}, postorder) for the modules
+    # reachable from 'entry', see Cooper, Harvey and Kennedy, "A Simple,
+    # Fast Dominance Algorithm"
+    order = []
+    seen = {entry}
+    stack = [(entry, iter(sorted(graph.get(entry, ()))))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if child not in seen:
+                seen.add(child)
+                stack.append((child, iter(sorted(graph.get(child, ())))))
+                break
+        else:
+            stack.pop()
+            order.append(node)
+    index = {node: i for i, node in enumerate(order)}
+    preds = {node: [] for node in order}
+    for node in order:
+        for child in graph.get(node, ()):
+            preds[child].append(node)
+    idom = {entry: entry}
+
+    def intersect(a, b):
+        while a != b:
+            while index[a] < index[b]:
+                a = idom[a]
+            while index[b] < index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for node in reversed(order):
+            if node == entry:
+                continue
+            new = None
+            for pred in preds[node]:
+                if pred in idom:
+                    new = pred if new is None else intersect(pred, new)
+            if idom.get(node) != new:
+                idom[node] = new
+                changed = True
+    return idom, order
+
+
+def lazy_savings(graph, cost, entry):
+    # {module: (cost, count)} of the modules importing 'entry' would no
+    # longer import at startup if that module were lazy: the module and
+    # everything only reachable through it, the modules it dominates
+    idom, order = dominators(graph, entry)
+    total = {node: (cost.get(node, 0), 1) for node in order}
+    # a dominator comes after the modules it dominates in postorder
+    for node in order:
+        if node != entry:
+            up = idom[node]
+            total[up] = (total[up][0] + total[node][0],
+                         total[up][1] + total[node][1])
+    return total
+
+
+def print_graph_report(graph, cost, entry, top=20, measured=False):
+    if entry not in graph:
+        print(f'error: entry point {entry!r} not found')
+        return False
+    savings = lazy_savings(graph, cost, entry)
+    kind = 'measured' if measured else 'estimated'
+    startup, count = savings.pop(entry)
+    print(f'startup of {entry}: {startup / 1000:.1f} ms {kind}, '
+          f'{count} modules')
+    print('Making one of these modules lazy would save:')
+    print('  saved ms  self ms  modules  module')
+    ranked = sorted(savings.items(), key=lambda item: -item[1][0])
+    for name, (saved, n) in ranked[:top]:
+        print(f'{saved / 1000:10.2f} {cost.get(name, 0) / 1000:8.2f} '
+              f'{n:8d}  {name}')
+    return True
+
+
+def _options_key():
+    return repr([(k, getattr(OPTIONS, k, None)) for k in RESULT_OPTIONS])
+
+
+def analyze_file(fn):
+    # The analysis of source file 'fn' as a JSON-able dict: whether the
+    # module is 'safe', the 'imports', the 'unsafe' (lineno, message)
+    # notes and the 'statements' verdicts, see statement_verdicts().  If
+    # it can't be read or parsed, 'error' says why.  Results are cached
+    # by source contents.
+    try:
+        with open(fn, 'rb') as fp:
+            buf = fp.read()
+    except OSError as e:
+        return {'file': fn, 'error': str(e)}
+    cache = key = None
+    if OPTIONS.cache_dir:
+        cache = lazy_cache.Cache(OPTIONS.cache_dir)
+        key = lazy_cache.make_key('analyze', _options_key(), buf)
+        data = cache.get(key)
+        if data is not None:
+            return dict(file=fn, **json.loads(data))
+    try:
+        node = parse(buf, fn)
+        future = 'annotations' in future_flags(node)[1]
+        a = Analyzer(fn, future_annotations=future)
+        a.analyze(node)
+        result = {'safe': a.safe, 'imports': a.imports,
+                  'unsafe': a.notes,
+                  'statements': statement_verdicts(node, fn)}
+    except (SyntaxError, UnicodeDecodeError, ValueError, RuntimeError) as e:
+        result = {'error': f'{e.__class__.__name__}: {e}'}
+    if cache is not None:
+        cache.put(key, json.dumps(result).encode())
+    return dict(file=fn, **result)
+
+
+def _analyze_batch(files, options):
+    global OPTIONS
+    OPTIONS = options
+    return [analyze_file(fn) for fn in files]
+
+
+def analyze_files(files, workers=1):
+    # Yield analyze_file() results for 'files', in order.  With more
+    # than one worker, a pool of processes does the work, only a bounded
+    # number of batches are queued at any time.
+    if workers == 1 or ProcessPoolExecutor is None:
+        for fn in files:
+            yield analyze_file(fn)
+        return
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        limit = executor._max_workers * WORKER_QUEUE
+        pending = deque()
+        batch = []
+        for fn in files:
+            batch.append(fn)
+            if len(batch) == WORKER_BATCH:
+                pending.append(executor.submit(_analyze_batch, batch,
+                                               OPTIONS))
+                batch = []
+            while len(pending) >= limit:
+                yield from pending.popleft().result()
+        if batch:
+            pending.append(executor.submit(_analyze_batch, batch, OPTIONS))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _iter_files(args):
+    # the files in 'args', directories searched for .py files
+    for arg in args:
+        if os.path.isdir(arg):
+            for dirpath, dirnames, filenames in os.walk(arg):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    if fn.endswith('.py'):
+                        yield os.path.join(dirpath, fn)
+        else:
+            yield arg
+
+USAGE = """Usage: %prog [-v] file [...]
+       %prog --graph -e MODULE dir [...]"""
 
 def main():
     global OPTIONS
@@ -217,29 +774,64 @@ def main():
                       help="enable extra status output")
     parser.add_option('-b', '--allow-bases', action='store_true',
                       help="allow base classes")
+    parser.add_option('--graph', action='store_true',
+                      help="report the modules worth making lazy to "
+                           "speed up importing the entry point")
+    parser.add_option('-e', '--entry', metavar='MODULE',
+                      help="entry point module for --graph")
+    parser.add_option('--importtime', metavar='FILE',
+                      help="costs from 'python -X importtime' output "
+                           "instead of estimates")
+    parser.add_option('--top', type='int', default=20,
+                      help="number of modules to report")
+    parser.add_option('--pure', metavar='NAME', action='append',
+                      dest='pure_names', default=list(OPTIONS.pure_names),
+                      help="a name, or fnmatch pattern, that is safe to "
+                           "call and use as a decorator")
+    parser.add_option('-j', '--workers', type='int', default=1,
+                      help="number of worker processes, 0 for one per "
+                           "CPU")
+    parser.add_option('--cache-dir', metavar='DIR',
+                      default=OPTIONS.cache_dir,
+                      help="persistent cache of analysis results "
+                           "(default: $LAZY_COMPILE_CACHE)")
+    parser.add_option('--jsonl', action='store_true',
+                      help="print one JSON object per file")
     OPTIONS, args = parser.parse_args()
+    if OPTIONS.graph:
+        if not OPTIONS.entry:
+            parser.error('--graph requires --entry')
+        graph, cost = build_graph(args)
+        if OPTIONS.importtime:
+            cost = read_importtime(OPTIONS.importtime, graph)
+        if not print_graph_report(graph, cost, OPTIONS.entry, OPTIONS.top,
+                                  measured=bool(OPTIONS.importtime)):
+            sys.exit(1)
+        return
     lazy = set()
     eager = set()
-    for fn in args:
-        try:
-            fp = tokenize.open(fn)
-        except SyntaxError:
+    statements = lazy_statements = 0
+    for result in analyze_files(_iter_files(args), OPTIONS.workers):
+        if OPTIONS.jsonl:
+            print(json.dumps(result), flush=True)
             continue
-        try:
-            buf = fp.read()
-        except UnicodeDecodeError:
-            continue
-        finally:
-            fp.close()
-        try:
-            node = parse(buf)
-        except SyntaxError:
+        if 'error' in result:
             continue
-        a = analyze(node, fn)
-        if not a.safe:
+        fn = result['file']
+        notes = result['unsafe']
+        if OPTIONS.verbose:
+            # only the first warning unless very verbose
+            for lineno, msg in notes[:None if OPTIONS.verbose > 1 else 1]:
+                print(f'{fn}:{lineno or "???"}: {msg}')
+        if not result['safe']:
             eager.add(fn)
         else:
             lazy.add(fn)
+        for lineno, name, safe, notes in result['statements']:
+            statements += 1
+            lazy_statements += safe
+    if OPTIONS.jsonl:
+        return
     total = len(lazy) + len(eager)
     if not total:
         print('warning: no Python modules parsed.')
@@ -251,6 +843,9 @@ def main():
     for fn in sorted(lazy):
         print(f'    {fn}')
     print(f'{len(lazy) / total * 100:.1f}% - total: {total}')
+    if statements:
+        print(f'{lazy_statements / statements * 100:.1f}% of definitions '
+              f'- total: {statements}')
 
 
 if __name__ == '__main__':
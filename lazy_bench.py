@@ -0,0 +1,293 @@
+# Benchmark lazy modules against normally compiled ones.
+#
+# A corpus of synthetic modules of a few sizes and a slice of the
+# standard library is copied twice, compiled once with compileall and
+# once with lazy_compile.  Each measurement runs in a fresh, isolated
+# interpreter that imports nothing from the corpus before it starts
+# timing.  lazy_helper is imported before too, lazy modules need it but
+# it is paid once per process, its own import is reported on a
+# separate row.
+#
+#
+#   import  cold import time (first import in the process) and warm
+#           import time (imported again after dropping the modules)
+#   memory  tracemalloc and RSS growth for the import, and traced
+#           memory once every lazy name is woken
+#   access  first access latency of each top-level name, through the
+#           lazy_helper hook for lazy modules
+#   call    steady state cost of a loop calling a module global, after
+#           it is woken (synthetic modules only)
+#
+# Results are written as JSON so runs can be compared.
+
+import argparse
+import ast
+import compileall
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SIZES = (10, 100, 1000)
+STDLIB = ('argparse', 'textwrap', 'shlex', 'json', 'email.message')
+
+HELPER = 'lazy_helper'
+
+# runs in the child, only imports modules that can't be in the corpus
+CHILD = r'''
+import sys, time
+mode, path, repo, name = sys.argv[1:5]
+sys.path[:0] = [path, repo]
+if name != 'lazy_helper':
+    # with importlib, which its prewake() uses
+    import lazy_helper, importlib
+
+def purge():
+    for key, mod in list(sys.modules.items()):
+        if (getattr(mod, '__file__', None) or '').startswith(path):
+            del sys.modules[key]
+
+def rss():
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        # os is imported at startup already
+        import os
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def load():
+    __import__(name)
+    return sys.modules[name]
+
+result = {}
+if mode == 'import':
+    t0 = time.perf_counter()
+    load()
+    result['cold_ms'] = (time.perf_counter() - t0) * 1e3
+    warm = []
+    for i in range(5):
+        purge()
+        t0 = time.perf_counter()
+        load()
+        warm.append(time.perf_counter() - t0)
+    result['warm_ms'] = min(warm) * 1e3
+elif mode == 'memory':
+    import tracemalloc
+    before = rss()
+    tracemalloc.start()
+    mod = load()
+    current, peak = tracemalloc.get_traced_memory()
+    result['rss_kb'] = (rss() - before) / 1024
+    result['traced_kb'] = current / 1024
+    result['peak_kb'] = peak / 1024
+    lazy_helper = sys.modules['lazy_helper']
+    if any(isinstance(m, lazy_helper.Lazy)
+           for m in list(sys.modules.values())):
+        lazy_helper.prewake()
+    result['woken_kb'] = tracemalloc.get_traced_memory()[0] / 1024
+elif mode == 'access':
+    import ast
+    mod = load()
+    with open(mod.__file__, 'rb') as fp:
+        tree = ast.parse(fp.read())
+    names = [node.name for node in tree.body
+             if isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    names += [node.targets[0].id for node in tree.body
+              if isinstance(node, ast.Assign) and
+                 isinstance(node.targets[0], ast.Name)]
+    times = []
+    for n in names:
+        t0 = time.perf_counter_ns()
+        getattr(mod, n, None)
+        times.append(time.perf_counter_ns() - t0)
+    times.sort()
+    result['names'] = len(times)
+    if times:
+        result['mean_us'] = sum(times) / len(times) / 1e3
+        result['median_us'] = times[len(times) // 2] / 1e3
+        result['max_us'] = times[-1] / 1e3
+elif mode == 'call':
+    mod = load()
+    loop = getattr(mod, 'bench_loop', None)
+    if loop is not None:
+        loop(1000)
+        n = 200000
+        best = None
+        for i in range(5):
+            t0 = time.perf_counter_ns()
+            loop(n)
+            t = (time.perf_counter_ns() - t0) / n
+            best = t if best is None else min(best, t)
+        result['loop_ns'] = best
+print(repr(result))
+'''
+
+
+def synthetic_source(n):
+    # a module with 'n' small functions, n // 10 classes and constants,
+    # the kind of definitions lazy_compile makes lazy
+    lines = ['"""Synthetic benchmark module."""', '']
+    for i in range(n):
+        lines += [f'def func_{i}(x):', f'    return x + {i}', '']
+    for i in range(max(n // 10, 1)):
+        lines += [f'class Class_{i}:',
+                  f'    kind = {i}',
+                  '    def __init__(self, value):',
+                  '        self.value = value',
+                  '    def get(self):',
+                  '        return self.value + self.kind',
+                  '    def __repr__(self):',
+                  f'        return "Class_{i}(%r)" % self.value',
+                  '']
+        lines += [f'CONST_{i} = ({i}, "value {i}", {float(i)})', '']
+    lines += ['def bench_loop(n):',
+              '    total = 0',
+              '    for i in range(n):',
+              '        total += func_0(i)',
+              '    return total',
+              '']
+    return '\n'.join(lines)
+
+
+def make_corpus(path, sizes=SIZES, stdlib=STDLIB):
+    # Write the corpus to 'path', return the names of the modules to
+    # measure.  Standard library modules are copied with their package.
+    os.makedirs(path)
+    modules = []
+    for n in sizes:
+        name = f'synth_{n}'
+        with open(os.path.join(path, name + '.py'), 'w') as fp:
+            fp.write(synthetic_source(n))
+        modules.append(name)
+    libdir = os.path.dirname(os.__file__)
+    for name in stdlib:
+        top = name.partition('.')[0]
+        src = os.path.join(libdir, top)
+        if os.path.isdir(src):
+            dst = os.path.join(path, top)
+            if not os.path.exists(dst):
+                shutil.copytree(src, dst, ignore=shutil.ignore_patterns(
+                        '__pycache__', 'test', 'tests'))
+        elif os.path.isfile(src + '.py'):
+            shutil.copy(src + '.py', path)
+        else:
+            print(f'warning: {name} not found, skipped')
+            continue
+        modules.append(name)
+    return modules
+
+
+def build(corpus, path, lazy):
+    # copy 'corpus' to 'path' and compile it, with lazy_compile if 'lazy'
+    shutil.copytree(corpus, path)
+    if lazy:
+        import lazy_compile
+        ok = lazy_compile.compile_dir(path, quiet=2, force=True)
+    else:
+        ok = compileall.compile_dir(path, quiet=2, force=True)
+    if not ok:
+        print(f'warning: some files in {path} failed to compile')
+
+
+def run_child(mode, path, name):
+    repo = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-I', '-c', CHILD, mode, path,
+                           repo, name],
+                          capture_output=True, text=True)
+    if proc.returncode:
+        raise RuntimeError(f'{mode} {name} failed:\n{proc.stderr}')
+    return ast.literal_eval(proc.stdout.strip().splitlines()[-1])
+
+
+def measure(path, name, repeat):
+    # the measurements for module 'name' in build 'path'; import times
+    # are medians over 'repeat' processes
+    runs = [run_child('import', path, name) for i in range(repeat)]
+    result = {key: statistics.median(run[key] for run in runs)
+              for key in runs[0]}
+    result.update(run_child('memory', path, name))
+    if name == HELPER:
+        return result
+    result['access'] = run_child('access', path, name)
+    result.update(run_child('call', path, name))
+    return result
+
+
+def print_results(results):
+    print(f'{"module":16s} {"build":5s} {"cold ms":>8s} {"warm ms":>8s} '
+          f'{"peak KB":>8s} {"woken KB":>9s} {"access us":>9s} '
+          f'{"loop ns":>8s}')
+    rows = [(HELPER, 'lazy', results['helper'])]
+    rows += [(name, kind, r) for name, builds in results['modules'].items()
+             for kind, r in builds.items()]
+    for name, kind, r in rows:
+        access = r.get('access', {}).get('mean_us')
+        access = f'{access:9.2f}' if access is not None else f'{"-":>9s}'
+        loop = r.get('loop_ns')
+        loop = f'{loop:8.1f}' if loop is not None else f'{"-":>8s}'
+        print(f'{name:16s} {kind:5s} {r["cold_ms"]:8.2f} '
+              f'{r["warm_ms"]:8.2f} {r["peak_kb"]:8.1f} '
+              f'{r["woken_kb"]:9.1f} {access} {loop}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark lazy_compile output against normal .pyc '
+                    'files.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the results as JSON to FILE')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='processes per import time measurement')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='sizes of the synthetic modules, in functions')
+    parser.add_argument('--stdlib', default=','.join(STDLIB),
+                        help='standard library modules to include')
+    parser.add_argument('--workdir', metavar='DIR',
+                        help='build the corpus in DIR and keep it')
+    args = parser.parse_args()
+
+    sizes = [int(n) for n in args.sizes.split(',') if n]
+    stdlib = [name for name in args.stdlib.split(',') if name]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='lazy_bench')
+    try:
+        corpus = os.path.join(workdir, 'src')
+        modules = make_corpus(corpus, sizes, stdlib)
+        builds = {'eager': os.path.join(workdir, 'eager'),
+                  'lazy': os.path.join(workdir, 'lazy')}
+        for kind, path in builds.items():
+            build(corpus, path, kind == 'lazy')
+        results = {
+            'python': sys.version,
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'repeat': args.repeat,
+            'sizes': sizes,
+            'stdlib': stdlib,
+            'modules': {},
+            }
+        repo = os.path.dirname(os.path.abspath(__file__))
+        results['helper'] = measure(repo, HELPER, args.repeat)
+        for name in modules:
+            results['modules'][name] = {
+                kind: measure(path, name, args.repeat)
+                for kind, path in builds.items()}
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=1)
+
+
+if __name__ == '__main__':
+    main()
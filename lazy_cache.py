@@ -0,0 +1,61 @@
+# Persistent, content addressed build cache for the lazy tools.
+#
+# Entries are plain files named by a hash of everything the result
+# depends on: the inputs given by the caller, the interpreter magic
+# number and the source of the tools themselves.  Files are written
+# atomically so any number of processes can share one cache directory.
+
+import os
+import hashlib
+import importlib.util
+from importlib._bootstrap_external import _write_atomic
+
+# results depend on the code of these tools too
+_TOOL_FILES = ('lazy_analyze.py', 'lazy_compile.py', 'lazy_helper.py')
+_tool_stamp = None
+
+
+def _get_tool_stamp():
+    global _tool_stamp
+    if _tool_stamp is None:
+        h = hashlib.blake2b(importlib.util.MAGIC_NUMBER, digest_size=16)
+        here = os.path.dirname(os.path.abspath(__file__))
+        for fn in _TOOL_FILES:
+            with open(os.path.join(here, fn), 'rb') as fp:
+                h.update(fp.read())
+        _tool_stamp = h.digest()
+    return _tool_stamp
+
+
+def make_key(*parts):
+    # hash str/bytes 'parts' into a cache key
+    h = hashlib.blake2b(_get_tool_stamp(), digest_size=20)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8', 'surrogatepass')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class Cache:
+    def __init__(self, path):
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        fn = self._file(key)
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            _write_atomic(fn, data)
+        except OSError:
+            pass # a cache that can't be written is just slower
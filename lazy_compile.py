@@ -33,112 +33,876 @@
 
 import sys
 import os
+import builtins
 import stat
-import imp
-import struct
 import ast
+import io
+import time
+import zlib
 import marshal
+import contextlib
+from collections import Counter, deque
 import importlib.util
 import py_compile
 from importlib.machinery import FileFinder, SourceFileLoader
 
 import lazy_analyze
+import lazyfilefinder
+import lazy_helper
+import lazy_cache
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
 
 PY_EXT = ".py"
 
+class OPTIONS:
+    # write lazy marshal data to a sidecar archive next to the .pyc
+    sidecar = False
+    # if set, only marshal data larger than this many bytes goes to the
+    # sidecar archive, smaller data stays inline
+    spill_threshold = None
+    # (path, data, stamp) of the dictionary used to compress marshal data
+    zdict = None
+    # directory of the persistent build cache, None to disable
+    cache_dir = os.environ.get('LAZY_COMPILE_CACHE')
+    # a py_compile.PycInvalidationMode, None for the py_compile default
+    invalidation_mode = None
+    # names to compile eagerly because profiles show they are nearly
+    # always woken, {module name: frozenset of names}
+    hot_names = {}
+    # traced runs each name was woken in, {module name: {name: runs}}
+    wake_runs = {}
+    # max number of lazy definitions woken together as a group
+    group_max = 16
+    # bind modules imported by top-level 'import' statements without
+    # running them until first used, see lazy_helper.lazy_import()
+    lazy_imports = False
+    # assignments of literals (see lazy_analyze.literal_value()) whose
+    # value marshals to at least this many bytes store the value itself
+    # instead of the code building it, None to compile them like other
+    # definitions
+    literal_min = 512
+    # defer the code of plain methods of classes that can't be lazy
+    # themselves, see Transformer._find_lazy_methods()
+    lazy_methods = False
+
+# compression dictionaries larger than the zlib window do not help
+ZDICT_SIZE = 32 * 1024
+# bytes of marshal data sampled to train a dictionary
+ZDICT_SAMPLE = 2 * 1024 * 1024
+# files handed to a worker process at a time, and the number of batches
+# in flight per worker.  Bounds memory use for huge trees.
+WORKER_BATCH = 8
+WORKER_QUEUE = 4
+# module level functions the interpreter finds in the module dict
+# itself (PEP 562), they can't be lazy
+MODULE_HOOKS = {'__getattr__', '__dir__'}
+# globals the import system sets before the module runs, the hook never
+# wakes a lazy binding of one
+MODULE_ATTRS = {'__name__', '__doc__', '__package__', '__loader__',
+                '__spec__', '__file__', '__cached__', '__builtins__',
+                '__path__'}
+
+
 class FileLoader(SourceFileLoader):
     @staticmethod
     def source_to_code(data, path, *, _optimize=-1):
-        node = parse(data, path)
+        node = parse(data, path, Transformer(path, optimize=_optimize))
         return compile(node, path, 'exec', dont_inherit=True,
                        optimize=_optimize)
 
 
+def _module_name(path):
+    # the module name for source 'path', going up through packages
+    dirname, base = os.path.split(os.path.abspath(path))
+    parts = [os.path.splitext(base)[0]]
+    if parts == ['__init__']:
+        parts = []
+    while os.path.isfile(os.path.join(dirname, '__init__.py')):
+        dirname, package = os.path.split(dirname)
+        parts.insert(0, package)
+    return '.'.join(parts)
+
+
+def read_profiles(paths, startup=None):
+    """Read lazy_helper traces written as JSON.
+
+    'paths' are trace files or directories of them.  Only wakes in the
+    first 'startup' seconds of a run are counted, if given.  Returns
+    ({module name: runs}, {module name: {name: frozenset of run
+    numbers}}).
+    """
+    import json
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, fn)
+                         for fn in sorted(os.listdir(path))
+                         if fn.endswith('.json'))
+        else:
+            files.append(path)
+    runs = Counter()
+    woken = {}
+    for run, fn in enumerate(files):
+        with open(fn) as fp:
+            trace = json.load(fp)
+        for modname, info in trace['modules'].items():
+            runs[modname] += 1
+            for w in info['woken']:
+                if startup is None or w['time'] <= startup:
+                    names = woken.setdefault(modname, {})
+                    names.setdefault(w['name'], set()).add(run)
+    woken = {modname: {name: frozenset(r) for name, r in names.items()}
+             for modname, names in woken.items()}
+    return runs, woken
+
+
+def hot_names(runs, woken, fraction=0.9):
+    # names woken in at least 'fraction' of the runs of their module,
+    # {module name: frozenset of names}
+    hot = {}
+    for modname, names in woken.items():
+        names = {name for name, r in names.items()
+                 if len(r) >= fraction * runs[modname]}
+        if names:
+            hot[modname] = frozenset(names)
+    return hot
+
+
+def _def_name(node):
+    # the global name bound by a lazy definition
+    if isinstance(node, ast.Assign):
+        return node.targets[0].id
+    return node.name
+
+
+# builtin classes made by type() that leave __init_subclass__() alone,
+# like object subclassing them runs no other code
+_PLAIN_BUILTINS = frozenset(
+        name for name, obj in vars(builtins).items()
+        if type(obj) is type and
+        not any('__init_subclass__' in vars(k) for k in obj.__mro__[:-1]))
+
+
+def _plain_classes(body):
+    # Classes of module 'body' whose creation runs no code elsewhere:
+    # without keywords, their bases plain builtins or earlier plain
+    # classes.  Metaclasses and __init_subclass__() of other bases run
+    # when the class is made, e.g. to register it in a plugin registry,
+    # so making it lazy would lose that.  Returns (plain classes, those
+    # that can be bases too: undecorated, not defining
+    # __init_subclass__()).
+    bound = _bound_names(body)
+    bases = _PLAIN_BUILTINS - bound.keys()
+    plain = set()
+    for cls in body:
+        if (not isinstance(cls, ast.ClassDef) or cls.keywords or
+                bound[cls.name] > 1 or
+                not all(isinstance(base, ast.Name) and base.id in bases
+                        for base in cls.bases)):
+            continue
+        plain.add(cls.name)
+        if (not cls.decorator_list and
+                '__init_subclass__' not in _bound_names(cls.body)):
+            bases.add(cls.name)
+    return plain, bases
+
+
+def _bound_names(stmts, names=None):
+    # Count the global names bound by module level 'stmts'.  Function
+    # and class bodies are not looked into.  'from m import *' may bind
+    # any name again, so with one all of them count as bound twice.
+    top = names is None
+    if top:
+        names = Counter()
+    for node in stmts:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.ClassDef)):
+            names[node.name] += 1
+            continue
+        for child in ast.walk(node):
+            if isinstance(child, ast.Name) and not isinstance(child.ctx,
+                                                              ast.Load):
+                names[child.id] += 1
+            elif isinstance(child, (ast.Import, ast.ImportFrom)):
+                for alias in child.names:
+                    name = alias.asname or alias.name.partition('.')[0]
+                    names[name] += 1
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                    ast.ClassDef)):
+                # nested in if/try/etc.
+                _bound_names([child], names)
+    if top and '*' in names:
+        for name in names:
+            names[name] += 1
+    return names
+
+
+def _is_private(name):
+    # is 'name' mangled when used in a class?
+    return name.startswith('__') and not name.endswith('__')
+
+
+def _needs_class(node):
+    # Does the code of method 'node' depend on being compiled in its
+    # class: it uses super() or __class__, or names the class mangles?
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and child.id in ('super', '__class__'):
+            return True
+        for field in ('id', 'attr', 'arg', 'name', 'asname', 'rest'):
+            value = getattr(child, field, None)
+            if isinstance(value, str) and _is_private(value):
+                return True
+        for field in ('names', 'kwd_attrs'):
+            for value in getattr(child, field, ()):
+                if isinstance(value, str) and _is_private(value):
+                    return True
+    return False
+
+
+def _local_names(node):
+    # names local to function or lambda 'node': its arguments and the
+    # names it binds, less those declared global
+    args = node.args
+    names = {arg.arg for arg in args.posonlyargs + args.args +
+             args.kwonlyargs + [args.vararg, args.kwarg] if arg}
+    declared = set()
+    todo = list(node.body) if isinstance(node.body, list) else [node.body]
+    while todo:
+        child = todo.pop()
+        if isinstance(child, ast.Name):
+            if not isinstance(child.ctx, ast.Load):
+                names.add(child.id)
+        elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                ast.ClassDef)):
+            # nested scopes only bind their name here
+            names.add(child.name)
+            todo.extend(getattr(child, 'decorator_list', ()))
+            continue
+        elif isinstance(child, ast.Lambda):
+            continue
+        elif isinstance(child, ast.Global):
+            declared.update(child.names)
+        elif isinstance(child, ast.alias):
+            names.add((child.asname or child.name).partition('.')[0])
+        elif isinstance(child, ast.ExceptHandler) and child.name:
+            names.add(child.name)
+        todo.extend(ast.iter_child_nodes(child))
+    return names - declared
+
+
+def _base_name(node):
+    # 'a' for a.b[c].d, None if it does not start with a name
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _changed_names(body):
+    # Global names of module 'body' whose value may change once bound:
+    # bound more than once, assigned in functions declaring them global,
+    # or changed through an attribute, item or method call.  Methods of
+    # imported modules and builtins are assumed not to change them, as
+    # are the plain methods of a class called through it, like
+    # 'Base.__init__(self)'.  Definitions reading these can't be
+    # deferred, they could see another value.
+    bound = _bound_names(body)
+    changed = {name for name, count in bound.items() if count > 1}
+    imported = set()
+    methods = {}
+    for stmt in body:
+        if isinstance(stmt, (ast.Import, ast.ImportFrom)):
+            for alias in stmt.names:
+                imported.add((alias.asname or alias.name).partition('.')[0])
+        elif isinstance(stmt, ast.ClassDef):
+            methods[stmt.name] = {
+                    node.name for node in stmt.body
+                    if isinstance(node, (ast.FunctionDef,
+                                         ast.AsyncFunctionDef)) and
+                    not node.decorator_list}
+    def own_method(func):
+        # Class.method, or Class.__init__ etc. it may inherit
+        if not isinstance(func.value, ast.Name):
+            return False
+        names = methods.get(func.value.id, ())
+        return func.attr in names or (func.attr.startswith('__') and
+                                      func.attr.endswith('__') and
+                                      func.value.id in methods)
+    def visit(node, local):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                             ast.Lambda)):
+            for child in getattr(node, 'decorator_list', []) + [
+                    node.args, getattr(node, 'returns', None)]:
+                if child is not None:
+                    visit(child, local)
+            inner = local | _local_names(node)
+            body = node.body if isinstance(node.body, list) else [node.body]
+            for child in body:
+                visit(child, inner)
+            return
+        if isinstance(node, ast.Global):
+            changed.update(node.names)
+        elif (isinstance(node, (ast.Attribute, ast.Subscript)) and
+                not isinstance(node.ctx, ast.Load)):
+            base = _base_name(node.value)
+            if base is not None and base not in local:
+                changed.add(base)
+        elif (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Attribute)):
+            base = _base_name(node.func.value)
+            if (base in bound and base not in local and
+                    base not in imported and not own_method(node.func)):
+                changed.add(base)
+        for child in ast.iter_child_nodes(node):
+            visit(child, local)
+    for stmt in body:
+        visit(stmt, frozenset())
+    return changed
+
+
+def _all_names(node, names=None, local=frozenset()):
+    # Every global name loaded anywhere in 'node', including function
+    # bodies, i.e. the names its code may look up at some point.  Names
+    # local to the function loading them are left out.
+    if names is None:
+        names = set()
+    if isinstance(node, ast.Name):
+        if isinstance(node.ctx, ast.Load) and node.id not in local:
+            names.add(node.id)
+    elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                           ast.Lambda)):
+        for child in getattr(node, 'decorator_list', []) + [
+                node.args, getattr(node, 'returns', None)]:
+            if child is not None:
+                _all_names(child, names, local)
+        inner = local | _local_names(node)
+        body = node.body if isinstance(node.body, list) else [node.body]
+        for child in body:
+            _all_names(child, names, inner)
+    else:
+        for child in ast.iter_child_nodes(node):
+            _all_names(child, names, local)
+    return names
+
+
+def _load_names(node, names=None):
+    # The names loaded when 'node' is executed.  Function bodies run
+    # when called, only their decorators, defaults and annotations are
+    # looked at.  Class bodies run at definition time.
+    if names is None:
+        names = set()
+    if isinstance(node, ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            names.add(node.id)
+    elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        for child in node.decorator_list + [node.args, node.returns]:
+            if child is not None:
+                _load_names(child, names)
+    elif isinstance(node, ast.Lambda):
+        _load_names(node.args, names)
+    else:
+        for child in ast.iter_child_nodes(node):
+            _load_names(child, names)
+    return names
+
+
+def _nested_loads(node, names=None, nested=False):
+    # The names loaded when 'node' is executed from class bodies and
+    # comprehensions, which look them up as globals rather than in the
+    # locals a group runs with, see lazy_helper._wake().
+    if names is None:
+        names = set()
+    if isinstance(node, ast.ClassDef):
+        for child in node.decorator_list + node.bases + node.keywords:
+            _nested_loads(child, names, nested)
+        for child in node.body:
+            _load_names(child, names)
+    elif isinstance(node, (ast.ListComp, ast.SetComp, ast.DictComp,
+                           ast.GeneratorExp)):
+        _load_names(node, names)
+    elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        for child in node.decorator_list + [node.args, node.returns]:
+            if child is not None:
+                _nested_loads(child, names)
+    elif not isinstance(node, ast.Lambda):
+        for child in ast.iter_child_nodes(node):
+            _nested_loads(child, names)
+    return names
+
+
 class Transformer(ast.NodeTransformer):
-    def __init__(self, fn, *args, **kwargs):
+    def __init__(self, fn, *args, path=None, optimize=-1, **kwargs):
         ast.NodeTransformer.__init__(self, *args, **kwargs)
         self.fn = fn
+        # real location of the source, 'fn' is the name used in code
+        self.path = path or fn
+        # for the lazy code too, the module's own code is compiled by
+        # the caller
+        self.optimize = _optimize_level(optimize)
         self.lazy_defs = set()
+        # (stmt, module, name) of the imports that can be deferred, see
+        # lazy_analyze.deferrable_imports()
+        self.imports = []
+        self.deferred = {}
+        self.modname = _module_name(self.path)
+        # lazy names that must be woken before a group runs, e.g. base
+        # classes, and those its functions use, woken right after it.
+        # Keyed by the first name of the group.
+        self.deps = {}
+        self.refs = {}
+        # names woken together, keyed by the first name of the group
+        self.groups = {}
+        # marshal data for each group, keyed by the first name of the
+        # group.  Compression happens when packing.
+        self.lazy_code = {}
+        # contents of the sidecar archive, if any
+        self.sidecar = None
+        # bytes of marshal data kept inline and spilled to the sidecar
+        self.inline_size = 0
+        self.spill_size = 0
+        # {method: 'Class.method'} for the lazy methods of eager classes
+        self.lazy_methods = {}
+        # marshalled values of the large literal tables, see
+        # _find_literals()
+        self.literals = {}
+        # source lines, set by parse(), used for cache keys
+        self.source_lines = None
+        # compiler flags and names of the module's __future__ imports,
+        # lazy definitions are compiled with them too
+        self.future_flags = 0
+        self.future_names = set()
+        # {stmt: reason} for every top-level definition that could be
+        # lazy, the reason it is eager or None if it is lazy
+        self.verdicts = {}
 
     def _is_lazy_assign(self, node):
         return (len(node.targets) == 1 and
                 isinstance(node.targets[0], ast.Name))
 
-    def visit_Module(self, node):
-        for stmt in node.body:
+    def _find_lazy_defs(self, body):
+        lazy = {}
+        verdicts = self.verdicts
+        for stmt in body:
             stmt_name = stmt.__class__.__name__
             if stmt_name in {'FunctionDef', 'ClassDef', 'Assign'}:
                 if stmt_name == 'Assign' and not self._is_lazy_assign(stmt):
                     continue
-                if lazy_analyze.is_lazy_safe(stmt):
-                    self.lazy_defs.add(stmt)
-        if not self.lazy_defs:
+                a = lazy_analyze.Analyzer(self.fn, future_annotations=(
+                        'annotations' in self.future_names))
+                a.analyze(stmt)
+                if a.safe:
+                    lazy[_def_name(stmt)] = stmt
+                    verdicts[stmt] = None
+                else:
+                    lineno, msg = a.notes[0]
+                    verdicts[stmt] = f'{msg} (line {lineno})'
+        # a name bound more than once must keep the order of bindings, as
+        # must one functions bind with 'global', names nearly always woken are cheaper eager
+        bound = _bound_names(body)
+        changed = _changed_names(body)
+        declared = {name for node in ast.walk(ast.Module(body, []))
+                    if isinstance(node, ast.Global) for name in node.names}
+        plain, _ = _plain_classes(body)
+        hot = OPTIONS.hot_names.get(self.modname, ())
+        for name, stmt in list(lazy.items()):
+            if bound[name] > 1:
+                verdicts[stmt] = 'bound more than once'
+            elif name in declared:
+                # the module level binding compiles to STORE_GLOBAL then,
+                # which skips the staging of lazy_helper._wake()
+                verdicts[stmt] = 'declared global in a function'
+            elif isinstance(stmt, ast.ClassDef) and name not in plain:
+                verdicts[stmt] = 'bases or keywords may run code'
+            elif _load_names(stmt) & changed:
+                verdicts[stmt] = 'reads {} which changes'.format(
+                        ', '.join(sorted(_load_names(stmt) & changed)))
+            elif name in hot:
+                verdicts[stmt] = 'hot in profile'
+            elif name in MODULE_HOOKS:
+                verdicts[stmt] = 'module hook'
+            elif name in MODULE_ATTRS:
+                verdicts[stmt] = 'set by the import system'
+            else:
+                continue
+            del lazy[name]
+        # Globals looked up by code inside the module don't go through
+        # the module __getattr__.  Names eager code uses, at import time
+        # or later in function bodies, can't be lazy, that makes their
+        # definitions eager too.  What lazy code uses is woken with it,
+        # see _compile_groups().
+        lazy_stmts = set(lazy.values())
+        todo = [stmt for stmt in body if stmt not in lazy_stmts]
+        while todo:
+            user = todo.pop()
+            if user in verdicts:
+                label = _def_name(user)
+            else:
+                label = f'line {user.lineno}'
+            for name in _all_names(user) & lazy.keys():
+                stmt = lazy.pop(name)
+                verdicts[stmt] = f'used by eager code ({label})'
+                todo.append(stmt)
+        return lazy
+
+    def _find_lazy_methods(self, body, lazy):
+        # Classes that stay eager can still have lazy methods: the class
+        # body gets a lazy_helper.LazyMethod placeholder that makes the
+        # method when it is first looked up.  The code is compiled as a
+        # module level function, so only plain methods qualify: not
+        # decorated, special (the interpreter finds those in the class
+        # dict itself) or private, not needing the class scope or the
+        # __class__ cell, and not used by the class body.  Defaults and
+        # annotations must not read names that change, like lazy
+        # definitions, see _changed_names().
+        #
+        # Class decorators, metaclasses and __init_subclass__() see the
+        # class dict while the placeholders are there, so only plain
+        # classes without decorators qualify, see _plain_classes().
+        hot = OPTIONS.hot_names.get(self.modname, ())
+        future_annotations = 'annotations' in self.future_names
+        plain, _ = _plain_classes(body)
+        changed = _changed_names(body)
+        for cls in body:
+            if (not isinstance(cls, ast.ClassDef) or cls.decorator_list or
+                    cls.name not in plain or cls.name in lazy):
+                continue
+            class_names = _bound_names(cls.body)
+            used = set()
+            for stmt in cls.body:
+                _load_names(stmt, used)
+            for stmt in cls.body:
+                if (isinstance(stmt, (ast.FunctionDef,
+                                      ast.AsyncFunctionDef)) and
+                        not stmt.decorator_list and
+                        not stmt.name.startswith('__') and
+                        class_names[stmt.name] == 1 and
+                        stmt.name not in used and
+                        not _load_names(stmt) & class_names.keys() and
+                        not _load_names(stmt) & changed and
+                        lazy_analyze.is_lazy_safe(stmt, future_annotations)
+                        and not _needs_class(stmt)):
+                    name = f'{cls.name}.{stmt.name}'
+                    if name not in hot:
+                        self.lazy_methods[stmt] = name
+
+    def _find_literals(self, lazy):
+        # Large literal tables are stored as their marshalled value,
+        # woken by one marshal.loads() instead of running the bytecode
+        # that builds them.  That is smaller too, a tuple or frozenset
+        # loads as the constant it is.  Each is a group of its own.
+        if OPTIONS.literal_min is None:
+            return
+        for name, stmt in lazy.items():
+            if not isinstance(stmt, ast.Assign):
+                continue
+            try:
+                data = marshal.dumps(lazy_analyze.literal_value(stmt.value))
+            except (ValueError, TypeError, SyntaxError, RecursionError):
+                continue
+            if len(data) >= OPTIONS.literal_min:
+                self.literals[name] = data
+
+    def _find_groups(self, lazy):
+        # Cluster lazy names that are likely used together so they can be
+        # woken by one unmarshal and exec: names woken in the same traced
+        # runs and names referring to each other.  Groups are kept below
+        # OPTIONS.group_max names.
+        #
+        # A group's deps are woken before it runs, so groups must not
+        # depend on each other in a cycle.  The deps of single names
+        # can't be, the module would not import, but merging groups can
+        # make one: for a -> c -> b, a and b merged need c first and c
+        # needs them.  Such merges are skipped.
+        #
+        # A group's code runs with its own names as locals, which class
+        # bodies don't see, so what they use stays in another group, a
+        # dep of theirs.
+        parent = {name: name for name in lazy}
+        members = {name: [name] for name in lazy}
+        deps = {name: _load_names(stmt) & lazy.keys()
+                for name, stmt in lazy.items()}
+        nested = {name: _nested_loads(stmt) & lazy.keys()
+                  for name, stmt in lazy.items()}
+        def root(name):
+            while parent[name] != name:
+                parent[name] = name = parent[parent[name]]
+            return name
+        def succ(r):
+            # the groups group 'r' depends on
+            return {root(d) for n in members[r] for d in deps[n]} - {r}
+        def reaches(start, goal):
+            # does group 'start' depend on 'goal' through another group?
+            seen = set()
+            todo = [r for r in succ(start) if r != goal]
+            while todo:
+                r = todo.pop()
+                if r == goal:
+                    return True
+                if r not in seen:
+                    seen.add(r)
+                    todo.extend(succ(r))
+            return False
+        def uses(a, b):
+            # do class bodies of group 'a' use names of group 'b'?
+            return any(nested[n] & set(members[b]) for n in members[a])
+        def union(a, b):
+            a = root(a)
+            b = root(b)
+            if a in self.literals or b in self.literals:
+                return
+            if (a != b and
+                    len(members[a]) + len(members[b]) <= OPTIONS.group_max and
+                    not reaches(a, b) and not reaches(b, a) and
+                    not uses(a, b) and not uses(b, a)):
+                parent[b] = a
+                members[a] += members.pop(b)
+        wake_runs = OPTIONS.wake_runs.get(self.modname, {})
+        together = {}
+        for name in lazy:
+            if name in wake_runs:
+                together.setdefault(wake_runs[name], []).append(name)
+        for names in together.values():
+            for name in names[1:]:
+                union(names[0], name)
+        for name, stmt in lazy.items():
+            for other in sorted(_all_names(stmt) & lazy.keys()):
+                union(name, other)
+        groups = {}
+        for name in lazy:
+            # in source order, the order the statements run in
+            groups.setdefault(root(name), []).append(name)
+        return list(groups.values())
+
+    def _compile_groups(self, lazy):
+        self._find_literals(lazy)
+        for group in self._find_groups(lazy):
+            deps = set()
+            refs = set()
+            for name in group:
+                deps |= _load_names(lazy[name])
+                refs |= _all_names(lazy[name])
+            deps = (deps & lazy.keys()) - set(group)
+            refs = (refs & lazy.keys()) - set(group) - deps
+            self.groups[group[0]] = tuple(group)
+            self.deps[group[0]] = tuple(sorted(deps))
+            self.refs[group[0]] = tuple(sorted(refs))
+            if group[0] in self.literals:
+                self.lazy_code[group[0]] = self.literals[group[0]]
+                continue
+            stmts = [lazy[name] for name in group]
+            self.lazy_code[group[0]] = self._compile_stmts(stmts)
+        # each method is woken on its own, what it uses is eager as its
+        # class is
+        for stmt, name in self.lazy_methods.items():
+            self.groups[name] = (name,)
+            self.deps[name] = ()
+            self.refs[name] = ()
+            self.lazy_code[name] = self._compile_stmts([stmt])
+
+    def visit_Module(self, node):
+        self.future_flags, self.future_names = (
+                lazy_analyze.future_flags(node))
+        lazy = self._find_lazy_defs(node.body)
+        self.lazy_defs = set(lazy.values())
+        if OPTIONS.lazy_methods:
+            self._find_lazy_methods(node.body, lazy)
+        used = set()
+        loaded = set()
+        for stmt in node.body:
+            if stmt not in self.lazy_defs:
+                _load_names(stmt, used)
+            _all_names(stmt, loaded)
+        self.imports = lazy_analyze.deferrable_imports(node.body, used,
+                                                       loaded)
+        if OPTIONS.lazy_imports:
+            for stmt, module, name in self.imports:
+                self.deferred.setdefault(stmt, {})[name] = module
+        if not (self.lazy_defs or self.lazy_methods or self.deferred):
             # nothing to do, skip __class__ and other stuff
             return self.generic_visit(node)
-        # add import of our helper function
-        imp = ast.ImportFrom(module='lazy_helper',
-                names=[ast.alias(name='set_class',
-                    asname='__lazy_set_class'),
-                    ],
-                level=0)
-        ast.fix_missing_locations(imp)
-        # call the helper function with module __name__
-        n = ast.Name(id='__lazy_set_class', ctx=ast.Load())
-        name = ast.Name(id='__name__', ctx=ast.Load())
-        call = ast.Call(func=n, args=[name], keywords=[], starargs=None,
-                kwargs=None)
-        call = ast.Expr(call)
-        ast.fix_missing_locations(call)
-        # create dict of marshal data for functions
-        assign_name = ast.Name(id='__lazy_data', ctx=ast.Store())
-        value = ast.Dict(keys=[], values=[])
-        assign = ast.Assign(targets=[assign_name], value=value)
-        # skip __future__ statements
+        # lazy definitions get removed from the body, their code ends up
+        # in self.lazy_code
+        first = node.body[0]
+        node = self.generic_visit(node)
+        # add import of our helper functions
+        names = []
+        if self.deferred:
+            names.append(ast.alias(name='lazy_import',
+                                   asname='__lazy_import'))
+        new = [ast.ImportFrom(module='lazy_helper', names=names, level=0)]
+        if self.lazy_methods:
+            # ends in __ so class bodies don't mangle it
+            names.append(ast.alias(name='LazyMethod',
+                                   asname='__lazy_method__'))
+        if self.lazy_defs or self.lazy_methods:
+            self._compile_groups(lazy)
+            names.append(ast.alias(name='set_class',
+                                   asname='__lazy_set_class'))
+            # call the helper function with module __name__ and the
+            # packed marshal data
+            n = ast.Name(id='__lazy_set_class', ctx=ast.Load())
+            name = ast.Name(id='__name__', ctx=ast.Load())
+            call = ast.Call(func=n, args=[name],
+                            keywords=self._pack_code())
+            new.append(ast.Expr(call))
+        # skip docstring and __future__ statements
         idx = 0
         for i, stmt in enumerate(node.body):
             if isinstance(stmt, ast.ImportFrom) and stmt.module == '__future__':
                 idx = i + 1
-        ast.copy_location(imp, node.body[0])
-        ast.copy_location(assign, node.body[0])
-        ast.fix_missing_locations(imp)
-        ast.fix_missing_locations(assign)
+            elif (i == 0 and isinstance(stmt, ast.Expr) and
+                    isinstance(stmt.value, ast.Constant) and
+                    isinstance(stmt.value.value, str)):
+                idx = 1
+        for stmt in new:
+            ast.copy_location(stmt, first)
+            ast.fix_missing_locations(stmt)
         # insert our new code into the start of module body
-        node.body[idx:idx] = [imp, call, assign]
-        return self.generic_visit(node)
+        node.body[idx:idx] = new
+        return node
 
-    def _compile_stmt(self, node):
-        code = compile(ast.Module(body=[node]), self.fn, 'exec')
-        return marshal.dumps(code)
+    def visit_Import(self, node):
+        # deferred imports become 'name = __lazy_import(module)'
+        deferred = self.deferred.get(node)
+        if not deferred:
+            return node
+        result = []
+        eager = [alias for alias in node.names
+                 if (alias.asname or alias.name) not in deferred]
+        if eager:
+            result.append(ast.Import(names=eager))
+        for name, module in deferred.items():
+            call = ast.Call(func=ast.Name(id='__lazy_import', ctx=ast.Load()),
+                            args=[ast.Constant(module)], keywords=[])
+            result.append(ast.Assign(
+                targets=[ast.Name(id=name, ctx=ast.Store())], value=call))
+        for stmt in result:
+            ast.copy_location(stmt, node)
+            ast.fix_missing_locations(stmt)
+        return result
 
-    def _store_code(self, code_name, mcode):
-        # store marshal data in the dict
-        name = ast.Name(id='__lazy_data', ctx=ast.Load())
-        index = ast.Index(ast.Str(code_name))
-        target = ast.Subscript(value=name, slice=index, ctx=ast.Store())
-        assign = ast.Assign(targets=[target], value=ast.Bytes(mcode))
-        ast.fix_missing_locations(assign)
-        return assign
+    def _spill(self, mcode):
+        # should marshal data go to the sidecar archive?
+        if OPTIONS.spill_threshold is not None:
+            return len(mcode) > OPTIONS.spill_threshold
+        return OPTIONS.sidecar
+
+    def _pack(self, code, leaders):
+        # Pack marshal data into one contiguous bytes object, one entry
+        # per group.  Names are sorted so the helper can bisect, names[i]
+        # is defined by the code for group j = slots[i], in
+        # data[offsets[j]:offsets[j+1]].  groups[j] are the names it
+        # defines, deps[j] the names to wake before running it and
+        # refs[j] those to wake after.
+        offsets = [0]
+        for leader in leaders:
+            offsets.append(offsets[-1] + len(code[leader]))
+        data = b''.join(code[leader] for leader in leaders)
+        slot = {name: j for j, leader in enumerate(leaders)
+                for name in self.groups[leader]}
+        names = tuple(sorted(slot))
+        slots = tuple(slot[name] for name in names)
+        groups = tuple(self.groups[leader] for leader in leaders)
+        deps = tuple(self.deps[leader] for leader in leaders)
+        refs = tuple(self.refs[leader] for leader in leaders)
+        return names, slots, tuple(offsets), groups, deps, refs, data
+
+    def _pack_code(self):
+        # The index tuples are constants, building them costs nothing at
+        # import time.
+        code = self.lazy_code
+        if OPTIONS.zdict is not None:
+            zdict = OPTIONS.zdict[1]
+            code = {k: deflate(v, zdict) for k, v in code.items()}
+        inline = []
+        spill = []
+        for code_name in sorted(code):
+            if self._spill(code[code_name]):
+                spill.append(code_name)
+            else:
+                inline.append(code_name)
+        keywords = []
+        if inline:
+            *index, data = self._pack(code, inline)
+            self.inline_size = len(data)
+            value = ast.Constant((*index, data))
+            keywords.append(ast.keyword(arg='inline', value=value))
+        if spill:
+            # keep the data on disk, the module only gets the index and
+            # a stamp to check the archive against
+            *index, data = self._pack(code, spill)
+            self.spill_size = len(data)
+            stamp = lazy_helper.sidecar_stamp(data)
+            self.sidecar = lazy_helper.SIDECAR_MAGIC + stamp + data
+            value = ast.Constant((*index, stamp))
+            keywords.append(ast.keyword(arg='sidecar', value=value))
+        if OPTIONS.zdict is not None:
+            # the dictionary is found relative to the module file
+            path, _, stamp = OPTIONS.zdict
+            here = os.path.dirname(os.path.abspath(self.path))
+            value = ast.Constant((os.path.relpath(path, here), stamp))
+            keywords.append(ast.keyword(arg='zdict', value=value))
+        return keywords
+
+    def _compile_stmts(self, nodes):
+        cache = _get_cache()
+        if cache is not None and self.source_lines is not None:
+            # the code only depends on the text and position of the
+            # statements, unchanged definitions in a changed file hit
+            parts = []
+            for node in nodes:
+                first = min([node.lineno] +
+                            [d.lineno for d in getattr(node,
+                                                       'decorator_list', ())])
+                parts.append(f'{node.lineno}:{node.col_offset}')
+                parts.append(''.join(
+                        self.source_lines[first-1:node.end_lineno]))
+            key = lazy_cache.make_key('stmt', self.fn, str(self.optimize),
+                                      str(self.future_flags), *parts)
+            mcode = cache.get(key)
+            if mcode is None:
+                mcode = self._compile_stmts_nocache(nodes)
+                cache.put(key, mcode)
+            return mcode
+        return self._compile_stmts_nocache(nodes)
+
+    def _compile_stmts_nocache(self, nodes):
+        code = compile(ast.Module(body=nodes, type_ignores=[]), self.fn,
+                       'exec', flags=self.future_flags, dont_inherit=True,
+                       optimize=self.optimize)
+        return marshal.dumps(code)
 
     def visit_FunctionDef(self, node):
+        name = self.lazy_methods.get(node)
+        if name is not None:
+            # 'meth = __lazy_method__(__name__, "Class.meth")'
+            n = ast.Name(id='__lazy_method__', ctx=ast.Load())
+            call = ast.Call(func=n,
+                            args=[ast.Name(id='__name__', ctx=ast.Load()),
+                                  ast.Constant(name)], keywords=[])
+            new = ast.Assign(targets=[ast.Name(id=node.name,
+                                               ctx=ast.Store())],
+                             value=call)
+            ast.copy_location(new, node)
+            return ast.fix_missing_locations(new)
         if node not in self.lazy_defs:
             return self.generic_visit(node) # compile as normal
-        mcode = self._compile_stmt(node)
-        return self._store_code(node.name, mcode)
+        # dropped from the module, compiled by _compile_groups()
+        return None
 
-    def visit_Assign(self, node):
-        if node not in self.lazy_defs:
-            return self.generic_visit(node)
-        else:
-            mcode = self._compile_stmt(node)
-            return self._store_code(node.targets[0].id, mcode)
+    visit_AsyncFunctionDef = visit_FunctionDef
+    visit_ClassDef = visit_FunctionDef
+    visit_Assign = visit_FunctionDef
 
-    def visit_ClassDef(self, node):
-        # FIXME make lazy if safe
-        return self.generic_visit(node)
 
 
 
-def parse(buf, filename='<string>'):
+def parse(buf, filename='<string>', t=None):
     if isinstance(buf, bytes):
         buf = importlib.util.decode_source(buf)
     try:
@@ -146,11 +910,460 @@ def parse(buf, filename='<string>'):
     except SyntaxError as e:
         # set the filename attribute
         raise SyntaxError(str(e), (filename, e.lineno, e.offset, e.text))
-    t = Transformer(filename)
+    if t is None:
+        t = Transformer(filename)
+    t.source_lines = buf.splitlines(True)
     return t.visit(node)
 
 
-def do_compile(file, cfile, dfile=None, doraise=False, optimize=-1):
+def deflate(data, zdict=None):
+    # raw deflate, no header, the helper knows how the data is compressed
+    if zdict is None:
+        c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    else:
+        c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+    return c.compress(data) + c.flush()
+
+
+def train_zdict(samples, size=ZDICT_SIZE, k=8, seglen=256):
+    # Build a preset compression dictionary from marshal data.  This is a
+    # much simplified version of the zstd "cover" algorithm: score each k
+    # byte chunk by the number of samples it occurs in, split the data
+    # into one epoch per dictionary segment and pick the best scoring
+    # segment of each.  The best segments go last, closest to the data
+    # being compressed.
+    samples = [s for s in samples if len(s) >= k]
+    total = sum(len(s) for s in samples)
+    if total > ZDICT_SAMPLE:
+        samples = samples[::total // ZDICT_SAMPLE + 1]
+    freq = Counter()
+    for sample in samples:
+        freq.update({sample[i:i+k] for i in range(len(sample) - k + 1)})
+    data = b''.join(samples)
+    epoch_size = max(seglen, len(data) // max(1, size // seglen))
+    window = seglen - k + 1
+    segments = []
+    for start in range(0, len(data), epoch_size):
+        epoch = data[start:start+epoch_size]
+        scores = []
+        for i in range(len(epoch) - k + 1):
+            n = freq[epoch[i:i+k]]
+            scores.append(n if n > 1 else 0)
+        score = best_score = sum(scores[:window])
+        best = 0
+        for i in range(window, len(scores)):
+            score += scores[i] - scores[i-window]
+            if score > best_score:
+                best_score = score
+                best = i - window + 1
+        if not best_score:
+            continue
+        segment = epoch[best:best+seglen]
+        for i in range(len(segment) - k + 1):
+            # don't pick the same chunks again
+            freq[segment[i:i+k]] = 0
+        segments.append((best_score, segment))
+    segments.sort(key=lambda s: s[0])
+    return b''.join(segment for score, segment in segments)[-size:]
+
+
+def write_zdict(path, zdict):
+    stamp = lazy_helper.sidecar_stamp(zdict)
+    importlib._bootstrap_external._write_atomic(
+            path, lazy_helper.ZDICT_MAGIC + stamp + zdict)
+    return (os.path.abspath(path), zdict, stamp)
+
+
+def read_zdict(path):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    header = len(lazy_helper.ZDICT_MAGIC) + lazy_helper.STAMP_SIZE
+    if not data.startswith(lazy_helper.ZDICT_MAGIC):
+        raise ValueError(f'{path!r} is not a lazy compression dictionary')
+    return (os.path.abspath(path), data[header:],
+            data[len(lazy_helper.ZDICT_MAGIC):header])
+
+
+def _iter_sources(dests, maxlevels=10, rx=None):
+    # the source files compile_dir() and compile_file() would look at
+    for dest in dests:
+        if os.path.isdir(dest):
+            files = _walk_dir(dest, maxlevels=maxlevels, quiet=2)
+        else:
+            files = [dest]
+        for fullname in files:
+            if not fullname.endswith(PY_EXT):
+                continue
+            if rx is not None and rx.search(fullname):
+                continue
+            yield fullname
+
+
+def _print_error(fullname, err, quiet):
+    # Report that compiling 'fullname' failed with 'err'.  Serial and
+    # parallel builds, bundles and reports all go through here so they
+    # print the same thing.
+    if quiet >= 2:
+        return
+    elif quiet:
+        print('*** Error compiling {!r}...'.format(fullname))
+    else:
+        print('*** ', end='')
+    if isinstance(err, py_compile.PyCompileError):
+        msg = err.msg
+    else:
+        msg = err.__class__.__name__ + ': ' + str(err)
+    # escape non-printable characters in msg, stdout is a StringIO
+    # without an encoding in workers
+    encoding = sys.stdout.encoding or 'utf-8'
+    print(msg.encode(encoding, errors='backslashreplace').decode(encoding))
+
+
+def _parse_file(fullname, quiet=2):
+    # Transformer of source 'fullname', None if it could not be parsed
+    t = Transformer(fullname)
+    try:
+        with open(fullname, 'rb') as fp:
+            parse(fp.read(), fullname, t)
+    except Exception as e:
+        _print_error(fullname, e, quiet)
+        return None
+    return t
+
+
+def collect_lazy_code(dests, maxlevels=10, rx=None, quiet=2):
+    # {filename: lazy_code} for the sources in 'dests', nothing written
+    result = {}
+    for fullname in _iter_sources(dests, maxlevels, rx):
+        if 'lazy_help' in fullname:
+            continue
+        t = _parse_file(fullname, quiet)
+        if t is None:
+            continue
+        if t.lazy_code:
+            result[fullname] = t.lazy_code
+    return result
+
+
+def collect_lazy_imports(dests, maxlevels=10, rx=None, quiet=2):
+    # {module name: [(module, attr, name)]} of the imports that can be
+    # deferred in the sources in 'dests', as lazyfilefinder.load_lazydb()
+    # returns them
+    lazydb = {}
+    for fullname in _iter_sources(dests, maxlevels, rx):
+        t = _parse_file(fullname, quiet)
+        if t is None:
+            continue
+        if t.imports:
+            lazydb[t.modname] = [(module, '', name)
+                                 for stmt, module, name in t.imports]
+    return lazydb
+
+
+def write_lazydb(path, lazydb):
+    # write 'lazydb' in the text format read by lazyfilefinder
+    with open(path, 'w') as fp:
+        fp.write('# module: imported module|bound name\n')
+        for modname in sorted(lazydb):
+            for module, attr, name in lazydb[modname]:
+                if attr:
+                    module = module + ':' + attr
+                if name and name != (attr or module):
+                    module = module + '|' + name
+                fp.write('{}: {}\n'.format(modname, module))
+
+
+def collect_report(dests, maxlevels=10, rx=None, quiet=2):
+    # {module name: [(lineno, name, reason, marshal size, code size)]}
+    # for the top-level definitions in the sources in 'dests', 'reason'
+    # is None for lazy ones.  Sizes are those of each definition
+    # compiled alone, the code size estimates the code objects it makes.
+    # Assignments make none, for them it is the size of the marshal
+    # data, or of the marshalled value for literal tables, see
+    # _find_literals().
+    report = {}
+    for fullname in _iter_sources(dests, maxlevels, rx):
+        if 'lazy_help' in fullname:
+            continue
+        t = _parse_file(fullname, quiet)
+        if t is None:
+            continue
+        rows = []
+        for stmt, reason in t.verdicts.items():
+            code = compile(ast.Module(body=[stmt], type_ignores=[]),
+                           fullname, 'exec', flags=t.future_flags,
+                           dont_inherit=True)
+            name = _def_name(stmt)
+            if name in t.literals:
+                size = code_size = len(t.literals[name])
+            else:
+                size = len(marshal.dumps(code))
+                code_size = lazy_helper.code_size(code)
+                if isinstance(stmt, ast.Assign):
+                    code_size = size
+            rows.append((stmt.lineno, name, reason, size, code_size))
+        if rows:
+            report[t.modname] = rows
+    return report
+
+
+def print_report(report, quiet=0, top=20):
+    # Per module and overall: what went lazy and what it saves until
+    # woken, why the rest is eager and what that costs, largest first.
+    total = [0, 0, 0, 0]
+    reasons = {}
+    eager = []
+    for modname in sorted(report):
+        rows = report[modname]
+        lazy = [row for row in rows if row[2] is None]
+        marshal_size = sum(row[3] for row in lazy)
+        code_size = sum(row[4] for row in lazy)
+        total[0] += len(lazy)
+        total[1] += len(rows)
+        total[2] += marshal_size
+        total[3] += code_size
+        if not quiet:
+            print(f'{modname}: {len(lazy)} of {len(rows)} lazy, saves '
+                  f'{marshal_size} bytes marshal, {code_size} bytes code')
+        for lineno, name, reason, marshal_size, code_size in rows:
+            if not quiet:
+                status = 'eager' if reason else 'lazy'
+                print(f'  {lineno:6d} {name:30s} {status:5s} '
+                      f'{marshal_size:8d} {code_size:8d}  {reason or ""}')
+            if reason:
+                kind = reason.partition(' (')[0]
+                count, size = reasons.get(kind, (0, 0))
+                reasons[kind] = (count + 1, size + code_size)
+                eager.append((code_size, f'{modname}.{name}', reason))
+    if not total[1]:
+        print('No definitions found.')
+        return
+    print(f'{total[0]} of {total[1]} definitions lazy '
+          f'({total[0] / total[1] * 100:.1f}%), saving {total[2]} bytes '
+          f'marshal, {total[3]} bytes code until woken')
+    if eager:
+        print('Eager definitions by reason:')
+        print('   count  code bytes  reason')
+        ranked = sorted(reasons.items(), key=lambda item: -item[1][1])
+        for kind, (count, size) in ranked[:top]:
+            print(f'  {count:6d}  {size:10d}  {kind}')
+        print('Largest eager definitions:')
+        print('  code bytes  definition  reason')
+        eager.sort(reverse=True)
+        for size, name, reason in eager[:top]:
+            print(f'  {size:10d}  {name}  {reason}')
+
+
+def _time_per_item(func, items):
+    t0 = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - t0) / len(items) * 1e6
+
+
+def print_zdict_stats(lazy_code, zdict=None):
+    # Report how much compressing the lazy marshal data would save on
+    # disk (and in memory for inline data), and what it costs to wake.
+    samples = [c for code in lazy_code.values() for c in code.values()]
+    if not samples:
+        print('No lazy definitions found.')
+        return
+    raw = sum(len(c) for c in samples)
+    print('{} lazy definitions in {} modules'.format(len(samples),
+                                                     len(lazy_code)))
+    usec = _time_per_item(marshal.loads, samples)
+    print('  raw:        {:10d} bytes, unmarshal {:.1f} us/def'.format(
+            raw, usec))
+    methods = [('zlib:', None)]
+    if zdict is not None:
+        methods.append(('zlib+zdict:', zdict))
+    for title, d in methods:
+        packed = [deflate(c, d) for c in samples]
+        size = sum(len(c) for c in packed)
+        usec = _time_per_item(lambda c: lazy_helper.inflate(c, d), packed)
+        print('  {:11s} {:10d} bytes ({:.1f}%), saves {} bytes, '
+              'inflate {:.1f} us/def'.format(title, size, size / raw * 100,
+                                             raw - size, usec))
+
+
+def _get_cache():
+    if OPTIONS.cache_dir:
+        return lazy_cache.Cache(OPTIONS.cache_dir)
+    return None
+
+
+def _get_invalidation_mode():
+    if OPTIONS.invalidation_mode is None:
+        return py_compile._get_default_invalidation_mode()
+    return OPTIONS.invalidation_mode
+
+
+def _options_key():
+    # everything besides the source that changes the compiler output
+    options = _get_options()
+    if options['zdict'] is not None:
+        path, _, stamp = options['zdict']
+        options['zdict'] = (path, stamp)
+    options.pop('cache_dir')
+    options.pop('invalidation_mode')
+    # only the profile of the file being compiled matters
+    options.pop('hot_names')
+    options.pop('wake_runs')
+    return repr((sorted(options.items()), lazy_analyze._options_key()))
+
+
+def _optimize_level(optimize):
+    # -1 is the level of the interpreter, as for compile()
+    return sys.flags.optimize if optimize < 0 else optimize
+
+
+def _file_cache_key(file, dfile, source_bytes, optimize):
+    parts = ['file', dfile or file, str(_optimize_level(optimize)),
+             _options_key()]
+    modname = _module_name(file)
+    hot = OPTIONS.hot_names.get(modname)
+    if hot:
+        parts.append(repr(sorted(hot)))
+    wake_runs = OPTIONS.wake_runs.get(modname)
+    if wake_runs:
+        parts.append(repr(sorted((name, sorted(runs))
+                                 for name, runs in wake_runs.items())))
+    if OPTIONS.zdict is not None:
+        # the dictionary is referred to relative to the source
+        parts.append(os.path.abspath(file))
+    return lazy_cache.make_key(*parts, source_bytes)
+
+
+def _pyc_header(source_bytes, source_stats):
+    # pyc header as written by importlib, see PEP 552
+    ext = importlib._bootstrap_external
+    mode = _get_invalidation_mode()
+    if mode == py_compile.PycInvalidationMode.TIMESTAMP:
+        return (importlib.util.MAGIC_NUMBER + ext._pack_uint32(0) +
+                ext._pack_uint32(source_stats['mtime']) +
+                ext._pack_uint32(source_stats['size']))
+    checked = mode == py_compile.PycInvalidationMode.CHECKED_HASH
+    flags = 0b1 | checked << 1
+    return (importlib.util.MAGIC_NUMBER + ext._pack_uint32(flags) +
+            importlib.util.source_hash(source_bytes))
+
+
+def _read_compiled(cfile):
+    # current (pyc, sidecar) contents for 'cfile', None if missing
+    try:
+        with open(cfile, 'rb') as fp:
+            data = fp.read()
+    except OSError:
+        return None, None
+    try:
+        with open(lazy_helper.sidecar_path(cfile), 'rb') as fp:
+            sidecar = fp.read()
+    except OSError:
+        sidecar = None
+    return data, sidecar
+
+
+def _is_fresh(file, cfile, dfile=None, optimize=-1):
+    # Is 'cfile' up to date for source 'file'?  With a build cache, the
+    # compiled output must match what the current source and options
+    # produce.  Without, check the pyc header against the source.
+    try:
+        with open(file, 'rb') as fp:
+            source_bytes = fp.read()
+        st = os.stat(file)
+    except OSError:
+        return False
+    data, sidecar = _read_compiled(cfile)
+    if data is None or len(data) < 16:
+        return False
+    stats = {'mtime': int(st.st_mtime), 'size': st.st_size}
+    if data[:16] != _pyc_header(source_bytes, stats):
+        return False
+    cache = _get_cache()
+    if cache is None:
+        return True
+    entry = cache.get(_file_cache_key(file, dfile, source_bytes, optimize))
+    if entry is None:
+        return False
+    code, cached_sidecar = marshal.loads(entry)[:2]
+    return data[16:] == code and sidecar == cached_sidecar
+
+
+def _compile_source(file, dfile, source_bytes, optimize):
+    # (code, sidecar, inline size, spilled size) for source 'file': the
+    # marshalled module code, the sidecar archive or None and the bytes
+    # of lazy data kept inline and spilled
+    cache = _get_cache()
+    if cache is not None:
+        key = _file_cache_key(file, dfile, source_bytes, optimize)
+        entry = cache.get(key)
+        if entry is not None:
+            return marshal.loads(entry)
+    t = Transformer(dfile or file, path=file, optimize=optimize)
+    node = parse(source_bytes, dfile or file, t)
+    code = marshal.dumps(compile(node, dfile or file, 'exec',
+                                 dont_inherit=True, optimize=optimize))
+    result = (code, t.sidecar, t.inline_size, t.spill_size)
+    if cache is not None:
+        cache.put(key, marshal.dumps(result))
+    return result
+
+
+def write_bundle(filename, dests, maxlevels=10, rx=None, optimize=-1,
+                 quiet=0):
+    """Compile the modules under 'dests' into one bundle file.
+
+    'dests' are directories on sys.path or single modules.  The module
+    code and the sidecar archives go into 'filename', see
+    lazyfilefinder.install_bundle().  lazy_helper is added so the
+    bundle needs nothing else.  Like compile_dir(), modules more than
+    'maxlevels' directories down or whose path matches 'rx' are left
+    out.  Returns true if all files compiled.
+    """
+    here = os.path.abspath(filename)
+    modules = {}
+    success = True
+    helper = os.path.splitext(lazy_helper.__file__)[0] + PY_EXT
+    sources = [(dest, False) for dest in dests] + [(helper, True)]
+    for dest, plain in sources:
+        for name, path, is_package in lazy_analyze._iter_modules(dest):
+            if name in modules:
+                continue
+            if not plain:
+                if rx is not None and rx.search(path):
+                    continue
+                rel = os.path.relpath(os.path.dirname(path), dest)
+                if rel != os.curdir and rel.count(os.sep) >= maxlevels:
+                    continue
+            parts = name.split('.')
+            if is_package:
+                parts.append('__init__')
+            dfile = os.path.join(here, *parts) + PY_EXT
+            if not quiet:
+                print('Compiling {!r}...'.format(path))
+            try:
+                with open(path, 'rb') as fp:
+                    source_bytes = fp.read()
+                if plain or 'lazy_help' in path:
+                    code = marshal.dumps(compile(
+                            importlib.util.decode_source(source_bytes),
+                            dfile, 'exec', dont_inherit=True,
+                            optimize=optimize))
+                    sidecar = None
+                else:
+                    code, sidecar, _, _ = _compile_source(
+                            path, dfile, source_bytes, optimize)
+            except Exception as e:
+                success = False
+                _print_error(path, e, max(quiet, 1))
+                continue
+            modules[name] = (is_package, code, sidecar)
+    lazyfilefinder.write_bundle(filename, modules)
+    return success
+
+
+def do_compile(file, cfile, dfile=None, doraise=False, optimize=-1,
+               stats=None):
     """Byte-compile one source file to Python bytecode.
 
     :param file: The source file name.
@@ -166,6 +1379,9 @@ def do_compile(file, cfile, dfile=None, doraise=False, optimize=-1):
     :param optimize: The optimization level for the compiler.  Valid values
         are -1, 0, 1 and 2.  A value of -1 means to use the optimization
         level of the current interpreter, as given by -O command line options.
+    :param stats: If given, a dict that gets the number of bytes of lazy
+        marshal data kept inline ('inline') and spilled to the sidecar
+        archive ('spilled').
 
     :return: Path to the resulting byte compiled file.
 
@@ -188,8 +1404,8 @@ def do_compile(file, cfile, dfile=None, doraise=False, optimize=-1):
     loader = FileLoader('<lazy_compile>', file)
     source_bytes = loader.get_data(file)
     try:
-        code = loader.source_to_code(source_bytes, dfile or file,
-                                     _optimize=optimize)
+        code, sidecar, inline_size, spill_size = _compile_source(
+                file, dfile, source_bytes, optimize)
     except Exception as err:
         raise # FIXME, remove
         py_exc = py_compile.PyCompileError(err.__class__, err, dfile or file)
@@ -205,10 +1421,18 @@ def do_compile(file, cfile, dfile=None, doraise=False, optimize=-1):
     except FileExistsError:
         pass
     source_stats = loader.path_stats(file)
-    bytecode = importlib._bootstrap_external._code_to_bytecode(
-            code, source_stats['mtime'], source_stats['size'])
+    bytecode = _pyc_header(source_bytes, source_stats) + code
     mode = importlib._bootstrap_external._calc_mode(file)
+    # write the sidecar first so the .pyc never refers to a missing one
+    sfile = lazy_helper.sidecar_path(cfile)
+    if sidecar is not None:
+        importlib._bootstrap_external._write_atomic(sfile, sidecar, mode)
+    elif os.path.isfile(sfile):
+        os.unlink(sfile)
     importlib._bootstrap_external._write_atomic(cfile, bytecode, mode)
+    if stats is not None:
+        stats['inline'] = inline_size
+        stats['spilled'] = spill_size
     return cfile
 
 # derived from compileall.py
@@ -253,15 +1477,72 @@ def compile_dir(dir, maxlevels=10, ddir=None, force=False, rx=None,
                no output with 2
     legacy:    if True, produce legacy pyc paths instead of PEP 3147 paths
     optimize:  optimization level or -1 for level of the interpreter
-    workers:   maximum number of parallel workers
+    workers:   maximum number of parallel workers, None or 0 to use
+               one per CPU
     """
     files = _walk_dir(dir, quiet=quiet, maxlevels=maxlevels, ddir=ddir)
-    success = 1
+    failed = []
+    if workers != 1 and ProcessPoolExecutor is not None:
+        args = (ddir, force, rx, quiet, legacy, optimize)
+        for file, ok, output in _compile_parallel(files, args,
+                                                  workers or None):
+            sys.stdout.write(output)
+            if not ok:
+                failed.append(file)
+    else:
+        for file in files:
+            if not compile_file(file, ddir, force, rx, quiet,
+                                legacy, optimize):
+                failed.append(file)
+    if failed and quiet < 2:
+        print('*** {} file(s) failed to compile:'.format(len(failed)))
+        for file in failed:
+            print('    {}'.format(file))
+    return 0 if failed else 1
+
+
+def _get_options():
+    return {k: v for k, v in vars(OPTIONS).items() if not k.startswith('_')}
+
+
+def _set_options(options):
+    for k, v in options.items():
+        setattr(OPTIONS, k, v)
+
+
+def _compile_batch(files, args):
+    # Run compile_file() in a worker process.  Output is collected and
+    # printed by the parent, in order.
+    results = []
     for file in files:
-        if not compile_file(file, ddir, force, rx, quiet,
-                            legacy, optimize):
-            success = 0
-    return success
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ok = compile_file(file, *args)
+        results.append((file, ok, out.getvalue()))
+    return results
+
+
+def _compile_parallel(files, args, workers):
+    # Yield (file, success, output) for 'files' compiled by a pool of
+    # worker processes, in the order of 'files'.  Only a bounded number
+    # of batches are queued at any time.
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_set_options,
+                             initargs=(_get_options(),)) as executor:
+        limit = executor._max_workers * WORKER_QUEUE
+        pending = deque()
+        batch = []
+        for file in files:
+            batch.append(file)
+            if len(batch) == WORKER_BATCH:
+                pending.append(executor.submit(_compile_batch, batch, args))
+                batch = []
+            while len(pending) >= limit:
+                yield from pending.popleft().result()
+        if batch:
+            pending.append(executor.submit(_compile_batch, batch, args))
+        while pending:
+            yield from pending.popleft().result()
 
 # derived from compileall.py
 def compile_file(fullname, ddir=None, force=False, rx=None, quiet=0,
@@ -299,50 +1580,29 @@ def compile_file(fullname, ddir=None, force=False, rx=None, quiet=0,
                                 fullname, optimization=opt)
             else:
                 cfile = importlib.util.cache_from_source(fullname)
-            cache_dir = os.path.dirname(cfile)
         head, tail = name[:-3], name[-3:]
         if tail == PY_EXT:
-            if not force:
-                try:
-                    mtime = int(os.stat(fullname).st_mtime)
-                    expect = struct.pack('<4sl', importlib.util.MAGIC_NUMBER,
-                                         mtime)
-                    with open(cfile, 'rb') as chandle:
-                        actual = chandle.read(8)
-                    if expect == actual:
-                        return success
-                except OSError:
-                    pass
+            if not force and _is_fresh(fullname, cfile, dfile, optimize):
+                return success
             if not quiet:
                 print('Compiling {!r}...'.format(fullname))
+            stats = {}
             try:
                 ok = do_compile(fullname, cfile, dfile, True,
-                                 optimize=optimize)
-            except py_compile.PyCompileError as err:
-                success = 0
-                if quiet >= 2:
-                    return success
-                elif quiet:
-                    print('*** Error compiling {!r}...'.format(fullname))
-                else:
-                    print('*** ', end='')
-                # escape non-printable characters in msg
-                msg = err.msg.encode(sys.stdout.encoding,
-                                     errors='backslashreplace')
-                msg = msg.decode(sys.stdout.encoding)
-                print(msg)
-            except (SyntaxError, UnicodeError, OSError) as e:
+                                 optimize=optimize, stats=stats)
+            except Exception as e:
+                # a file that blows up the compiler only fails itself,
+                # not the whole build
                 success = 0
-                if quiet >= 2:
-                    return success
-                elif quiet:
-                    print('*** Error compiling {!r}...'.format(fullname))
-                else:
-                    print('*** ', end='')
-                print(e.__class__.__name__ + ':', e)
+                _print_error(fullname, e, quiet)
             else:
                 if ok == 0:
                     success = 0
+                if (not quiet and stats and
+                        OPTIONS.spill_threshold is not None):
+                    print('    lazy data: {} bytes inline, {} bytes '
+                          'spilled'.format(stats['inline'],
+                                           stats['spilled']))
     return success
 
 # derived from compileall.py
@@ -418,9 +1678,92 @@ def main():
                               'to the equivalent of -l sys.path'))
     parser.add_argument('-j', '--workers', default=1,
                         type=int, help='Run compileall concurrently')
+    parser.add_argument('--sidecar', action='store_true',
+                        help=('write lazy definitions to a memory-mapped '
+                              'archive next to each .pyc instead of '
+                              'keeping them inline'))
+    parser.add_argument('--spill-threshold', metavar='BYTES', type=int,
+                        default=None,
+                        help=('keep lazy definitions of up to BYTES bytes '
+                              'of marshal data inline, write larger ones '
+                              'to the sidecar archive'))
+    parser.add_argument('--zdict', metavar='FILE', default=None,
+                        help=('compress lazy definitions using the '
+                              'dictionary in FILE'))
+    parser.add_argument('--train-zdict', action='store_true',
+                        help=('train the --zdict dictionary over all the '
+                              'files to compile and write it first'))
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        default=OPTIONS.cache_dir,
+                        help=('keep a build cache keyed on source content '
+                              'in DIR, files and definitions that did not '
+                              'change are not compiled again (default: '
+                              '$LAZY_COMPILE_CACHE)'))
+    invalidation_modes = sorted(mode.name.lower().replace('_', '-')
+                                for mode in py_compile.PycInvalidationMode)
+    parser.add_argument('--invalidation-mode',
+                        choices=invalidation_modes,
+                        help=('set .pyc invalidation mode; defaults to '
+                              '"checked-hash" if the SOURCE_DATE_EPOCH '
+                              'environment variable is set, and '
+                              '"timestamp" otherwise.'))
+    parser.add_argument('--profile', metavar='FILE', action='append',
+                        default=[],
+                        help=('lazy_helper JSON trace, or a directory of '
+                              'them; names woken in nearly all traced runs '
+                              'are compiled eagerly.  May be repeated.'))
+    parser.add_argument('--hot-fraction', metavar='F', type=float,
+                        default=0.9,
+                        help=('with --profile, the fraction of runs a name '
+                              'must be woken in to be compiled eagerly '
+                              '(default 0.9)'))
+    parser.add_argument('--hot-within', metavar='SECONDS', type=float,
+                        default=None,
+                        help=('with --profile, only count names woken in '
+                              'the first SECONDS of each run, e.g. during '
+                              'startup'))
+    parser.add_argument('--group-max', metavar='N', type=int,
+                        default=OPTIONS.group_max,
+                        help=('wake up to N lazy definitions that refer to '
+                              'each other, or are woken in the same traced '
+                              'runs, with one unmarshal and exec; 1 wakes '
+                              'each name on its own (default %(default)s)'))
+    parser.add_argument('--literal-min', metavar='BYTES', type=int,
+                        default=OPTIONS.literal_min,
+                        help=('store literal tables marshalling to at least '
+                              'BYTES as their value, woken by a single load; '
+                              '0 for all of them, -1 for none (default '
+                              '%(default)s)'))
+    parser.add_argument('--lazy-methods', action='store_true',
+                        help=('defer the code of plain methods of classes '
+                              'that are not lazy themselves, until the '
+                              'method is first looked up.  The class dict '
+                              'holds a placeholder until then'))
+    parser.add_argument('--lazy-imports', action='store_true',
+                        help=('defer running modules imported by top-level '
+                              'import statements until they are used'))
+    parser.add_argument('--lazydb', metavar='FILE', default=None,
+                        help=('write the imports that can be deferred to '
+                              'FILE, for lazyfilefinder'))
+    parser.add_argument('--bundle', metavar='FILE', default=None,
+                        help=('compile everything into one bundle FILE '
+                              'instead of .pyc files, see lazyfilefinder'))
+    parser.add_argument('--report', action='store_true',
+                        help=('report which definitions are lazy, why the '
+                              'others are not and the memory it saves, '
+                              'compile nothing'))
+    parser.add_argument('--stats', action='store_true',
+                        help=('report the size of lazy definitions with '
+                              'and without compression, compile nothing'))
 
     args = parser.parse_args()
     compile_dests = args.compile_dest
+    OPTIONS.sidecar = args.sidecar
+    OPTIONS.spill_threshold = args.spill_threshold
+    OPTIONS.cache_dir = args.cache_dir
+    if args.invalidation_mode:
+        ivl_mode = args.invalidation_mode.replace('-', '_').upper()
+        OPTIONS.invalidation_mode = py_compile.PycInvalidationMode[ivl_mode]
 
     if (args.ddir and (len(compile_dests) != 1
             or not os.path.isdir(compile_dests[0]))):
@@ -449,6 +1792,51 @@ def main():
     if args.workers is not None:
         args.workers = args.workers or None
 
+    OPTIONS.group_max = args.group_max
+    OPTIONS.literal_min = args.literal_min if args.literal_min >= 0 else None
+    OPTIONS.lazy_imports = args.lazy_imports
+    OPTIONS.lazy_methods = args.lazy_methods
+    if args.profile:
+        try:
+            runs, woken = read_profiles(args.profile, args.hot_within)
+        except (OSError, ValueError, KeyError) as e:
+            parser.exit('error reading profile: {}'.format(e))
+        OPTIONS.hot_names = hot_names(runs, woken, args.hot_fraction)
+        OPTIONS.wake_runs = woken
+
+    if args.train_zdict or args.stats:
+        lazy_code = collect_lazy_code(compile_dests, maxlevels, args.rx)
+    if args.train_zdict:
+        if not args.zdict:
+            parser.exit('--train-zdict requires --zdict FILE')
+        samples = [c for code in lazy_code.values() for c in code.values()]
+        OPTIONS.zdict = write_zdict(args.zdict, train_zdict(samples))
+        # pycs of unchanged sources would keep the stamp of the old
+        # dictionary, _is_fresh() only checks them against the source
+        args.force = True
+    elif args.zdict:
+        try:
+            OPTIONS.zdict = read_zdict(args.zdict)
+        except (OSError, ValueError) as e:
+            parser.exit('error reading dictionary: {}'.format(e))
+    if args.lazydb:
+        write_lazydb(args.lazydb,
+                     collect_lazy_imports(compile_dests, maxlevels, args.rx))
+    if args.bundle:
+        if OPTIONS.zdict is not None:
+            parser.exit('--zdict is not supported with --bundle')
+        if args.ddir or args.legacy:
+            parser.exit('-d and -b are not supported with --bundle')
+        return write_bundle(args.bundle, compile_dests, maxlevels, args.rx,
+                            quiet=args.quiet)
+    if args.report:
+        print_report(collect_report(compile_dests, maxlevels, args.rx,
+                                    args.quiet), args.quiet)
+        return True
+    if args.stats:
+        print_zdict_stats(lazy_code, OPTIONS.zdict and OPTIONS.zdict[1])
+        return True
+
     success = True
     try:
         if compile_dests:
@@ -480,5 +1868,5 @@ def alt_main():
 
 
 if __name__ == '__main__':
-    exit_status = int(not alt_main())
+    exit_status = int(not main())
     sys.exit(exit_status)
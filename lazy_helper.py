@@ -1,21 +1,1015 @@
+# Only builtin, frozen and extension modules are imported here, the
+# others may be lazy themselves and need this module to import.
+import os
 import sys
+import mmap
+import time
 import marshal
+from _thread import RLock, get_ident
 
-# global dict holding marshal data, keyed by func name
+# types.FunctionType and CodeType, the types module is not worth
+# importing for them
+_FunctionType = type(lambda: None)
+_CodeType = type((lambda: None).__code__)
+
+# global holding the lazy stores for the module
 LAZY_DATA = '__lazy_data'
+# global holding the woken groups eviction tracks, see evict()
+LAZY_WOKEN = '__lazy_woken'
+# global holding the module itself, its __name__ may be changed, e.g.
+# _pydecimal calls itself decimal
+LAZY_MODULE = '__lazy_module'
+
+# sidecar archive: magic, stamp, then the packed marshal data
+SIDECAR_EXT = '.lazy'
+SIDECAR_MAGIC = b'LZY\x01'
+STAMP_SIZE = 16
+
+# shared compression dictionary: magic, stamp, then the dictionary
+ZDICT_MAGIC = b'LZD\x01'
+
+# mapped sidecar archives and dictionaries, keyed by path.  Mappings
+# are read-only and file backed so unused pages only live in the page
+# cache, shared by all processes on the host.
+_archives = {}
+
+# the active Trace, see enable_trace()
+_trace = None
+# seconds a woken function is kept before evict() may drop it, None if
+# eviction is off, see enable_eviction()
+_evict_idle = None
+# states of a group evict() tracks besides (wake time, objects)
+_EVICTED = 'evicted'
+_PINNED = 'pinned'
+# lock serializing wakes in all modules, see _wake()
+_lock = RLock()
+# (store, group) of the groups being woken, see _wake()
+_waking = set()
+# {id of module dict: ({name: value}, [(store, group)], [name])} of
+# what the wakes in progress defined, put in the module once all
+# succeeded, and the refs to wake after them
+_staged = {}
+# {thread id: [(module name, names, code)]} of what ran in threads
+# calling prewake(), which reports it
+_woken_by = {}
+# module class of lazy_import() modules, made on first use
+_LazyModule = None
+
+
+def sidecar_path(cfile):
+    # sidecar archive for the .pyc file 'cfile'
+    return os.path.splitext(cfile)[0] + SIDECAR_EXT
+
+
+def sidecar_stamp(data):
+    import hashlib # only needed by the compiler
+    return hashlib.blake2b(data, digest_size=STAMP_SIZE).digest()
+
+
+def _map_archive(path, magic, stamp):
+    # 'path' mapped, without its header.  A cached mapping whose header
+    # is not the one expected is from before the archive was written
+    # again, e.g. compiled again and reloaded, it is mapped anew.  The
+    # stores of the old module keep the old mapping.
+    view = _archives.get(path)
+    header = magic + stamp
+    if view is None or view[:len(header)] != header:
+        with open(path, 'rb') as fp:
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        view = _archives[path] = memoryview(m)
+    return _check_archive(view, path, magic, stamp)
+
+
+def _check_archive(view, path, magic, stamp):
+    # 'view' without its header, if the header matches
+    header = magic + stamp
+    if view[:len(header)] != header:
+        raise ImportError(f'stale lazy archive {path!r}', path=path)
+    return view[len(header):]
+
+
+def inflate(data, zdict=None):
+    # undo lazy_compile compression, raw deflate with a preset dictionary
+    import zlib
+    if zdict is None:
+        d = zlib.decompressobj(-zlib.MAX_WBITS)
+    else:
+        d = zlib.decompressobj(-zlib.MAX_WBITS, zdict=zdict)
+    return d.decompress(data)
+
+
+class Packed:
+    """Marshal data for lazy definitions, packed into one buffer.
+
+    Names woken together are compiled into one code object, a group.
+    'names' is sorted, names[i] is defined by group j = slots[i], its
+    marshal data is data[offsets[j]:offsets[j+1]].  Slices are
+    memoryviews so waking a name does not copy the data.  groups[j] are
+    the names group j defines, deps[j] the lazy names that need to exist
+    before it runs, e.g. base classes, and refs[j] the lazy names its
+    functions use, woken right after it.  If 'zdict' is given, the
+    data is compressed, 'zdict' is the (path, magic, stamp) of the
+    dictionary.
+
+    Once a group has run its data is not needed any more and is
+    released, see release().  state[j] is LOADED once group j is read
+    and RELEASED once released.
+    """
+    __slots__ = ('names', 'slots', 'offsets', 'groups', 'deps', 'refs',
+                 'data', 'zdict', 'state', 'waste')
+
+    LOADED = 1
+    RELEASED = 2
+
+    def __init__(self, names, slots, offsets, groups, deps, refs, data,
+                 zdict=None):
+        self.names = names
+        self.slots = slots
+        self.offsets = offsets
+        self.groups = groups
+        self.deps = deps
+        self.refs = refs
+        self.data = data
+        self.zdict = zdict
+        self.state = None
+        # bytes of released data still in the buffer
+        self.waste = 0
+
+    def find(self, name):
+        # the group defining 'name', -1 if none
+        names = self.names
+        lo, hi = 0, len(names)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if names[mid] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(names) and names[lo] == name:
+            return self.slots[lo]
+        return -1
+
+    def buffer(self):
+        return memoryview(self.data)
+
+    def load(self, j):
+        # the marshal data for group j
+        if self.state is None:
+            self.state = bytearray(len(self.groups))
+        if self.state[j] == self.RELEASED:
+            raise ValueError(f'lazy data of {self.groups[j]} was released')
+        data = self.buffer()[self.offsets[j]:self.offsets[j+1]]
+        if self.zdict is not None:
+            data = inflate(data, _map_archive(*self.zdict))
+        self.state[j] = self.LOADED
+        return data
+
+    def is_released(self, j):
+        return self.state is not None and self.state[j] == self.RELEASED
+
+    def release(self, j):
+        # Group j has run and won't again, drop its data.  A bytes
+        # object can't shrink, the buffer is copied without the released
+        # data once that is half of it, so the copies add up to less than
+        # the original size.
+        if self.state is None or self.state[j] == self.RELEASED:
+            return False
+        self.state[j] = self.RELEASED
+        self.waste += self.offsets[j+1] - self.offsets[j]
+        if self.waste * 2 >= len(self.data):
+            self._compact()
+        return True
+
+    def _compact(self):
+        data = self.buffer()
+        parts = []
+        offsets = [0]
+        for j, state in enumerate(self.state):
+            if state != self.RELEASED:
+                parts.append(data[self.offsets[j]:self.offsets[j+1]])
+                offsets.append(offsets[-1] + len(parts[-1]))
+            else:
+                offsets.append(offsets[-1])
+        self.data = b''.join(parts)
+        self.offsets = tuple(offsets)
+        self.waste = 0
+
+    def resident(self):
+        # bytes of lazy data held in memory
+        return len(self.data)
+
+    def get(self, name):
+        i = self.find(name)
+        if i < 0:
+            return None
+        return self.load(i)
+
+
+class Sidecar(Packed):
+    """Packed marshal data kept in a sidecar archive next to the .pyc.
+
+    The archive is mmapped when the first name is woken, so importing
+    the module does no extra I/O.  With a 'loader', the archive comes
+    from loader.get_lazy_data(path) instead, 'path' being the module
+    name, for modules that are not files of their own.
+
+    Released data is dropped from memory a page at a time, with
+    madvise(), once all groups on the page are released.  'base' is
+    where the data starts in the mapping, None if that is not known.
+    """
+    __slots__ = ('path', 'stamp', 'loader', 'base', 'runs')
+
+    def __init__(self, names, slots, offsets, groups, deps, refs, stamp,
+                 path, zdict=None, loader=None):
+        Packed.__init__(self, names, slots, offsets, groups, deps, refs,
+                        None, zdict)
+        self.stamp = stamp
+        self.path = path
+        self.loader = loader
+        self.base = None
+        # runs of released groups, {first: end} and {end: first}
+        self.runs = ({}, {})
+
+    def buffer(self):
+        if self.data is None:
+            header = len(SIDECAR_MAGIC) + len(self.stamp)
+            if self.loader is None:
+                self.data = _map_archive(self.path, SIDECAR_MAGIC,
+                                         self.stamp)
+                self.base = header
+            else:
+                self.data = _check_archive(
+                        self.loader.get_lazy_data(self.path), self.path,
+                        SIDECAR_MAGIC, self.stamp)
+                offset = getattr(self.loader, 'get_lazy_offset', None)
+                if offset is not None:
+                    self.base = offset(self.path) + header
+        return self.data
+
+    def release(self, j):
+        if self.state is None or self.state[j] == self.RELEASED:
+            return False
+        self.state[j] = self.RELEASED
+        starts, ends = self.runs
+        first = ends.pop(j, j)
+        end = starts.pop(j + 1, j + 1)
+        starts[first] = end
+        ends[end] = first
+        m = self.data.obj
+        if self.base is None or not hasattr(m, 'madvise'):
+            return True
+        # the pages group j is on that the run now covers
+        page = mmap.PAGESIZE
+        lo = self.base + self.offsets[j]
+        hi = self.base + self.offsets[j+1]
+        run_lo = self.base + self.offsets[first]
+        run_hi = self.base + self.offsets[end]
+        start = max(lo - lo % page, run_lo + -run_lo % page)
+        stop = min(hi + -hi % page, run_hi - run_hi % page)
+        if stop > start:
+            try:
+                m.madvise(mmap.MADV_DONTNEED, start, stop - start)
+            except (AttributeError, OSError, ValueError):
+                pass # only an optimization
+        return True
+
+    def resident(self):
+        # bytes of data read and not released, the rest of the mapping
+        # only uses the page cache
+        if self.state is None:
+            return 0
+        return sum(self.offsets[j+1] - self.offsets[j]
+                   for j, state in enumerate(self.state)
+                   if state == self.LOADED)
+
+
+class Trace:
+    """Record of lazy modules and the names woken in them.
+
+    For each module: the number of lazy names registered and, for each
+    woken name, when it was woken (seconds since tracing started), the
+    caller that touched it and the time spent unmarshalling and
+    running its code.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # module name -> {'file':, 'registered':, 'woken': [...]}
+        self.modules = {}
+
+    def register(self, mod, count):
+        self.modules[mod.__name__] = {
+            'file': getattr(mod, '__file__', None),
+            'registered': count,
+            'woken': [],
+            }
+
+    def woke(self, mod, name, caller, load, run, group=()):
+        # 'group' are the other names defined by the same code
+        info = self.modules.get(mod.__name__)
+        if info is None:
+            return
+        info['woken'].append({
+            'name': name,
+            'time': time.perf_counter() - self.start,
+            'caller': caller,
+            'load_us': load * 1e6,
+            'exec_us': run * 1e6,
+            'group': [n for n in group if n != name],
+            })
+
+    def as_dict(self):
+        return {'pid': os.getpid(), 'argv': sys.argv,
+                'modules': self.modules}
+
+    def write(self, path, format=None):
+        # 'path' may contain {pid}, format is 'json' or 'flat', by
+        # default picked by the file extension
+        path = path.format(pid=os.getpid())
+        if format is None:
+            format = 'json' if path.endswith('.json') else 'flat'
+        with open(path, 'w') as fp:
+            if format == 'json':
+                import json
+                json.dump(self.as_dict(), fp, indent=1)
+            else:
+                self.write_flat(fp)
+
+    def write_flat(self, fp):
+        registered = sum(m['registered'] for m in self.modules.values())
+        woken = [(w, mod) for mod, m in self.modules.items()
+                 for w in m['woken']]
+        fp.write(f'# lazy wake profile, pid {os.getpid()}\n')
+        fp.write(f'# {len(woken)} of {registered} lazy names woken in '
+                 f'{len(self.modules)} modules\n')
+        fp.write('# time_ms   load_us   exec_us  name  caller\n')
+        woken.sort(key=lambda item: item[0]['time'])
+        for w, mod in woken:
+            fp.write(f"{w['time'] * 1e3:9.3f} {w['load_us']:9.1f} "
+                     f"{w['exec_us']:9.1f}  {mod}.{w['name']}  "
+                     f"{w['caller']}\n")
+
+
+def enable_trace(path=None, format=None):
+    """Start recording lazy module activity, return the Trace.
+
+    If 'path' is given, the trace is written there at exit, see
+    Trace.write().  Tracing is also enabled by setting LAZY_TRACE to a
+    path in the environment.  Only modules set up after this call are
+    recorded.
+    """
+    global _trace
+    if _trace is None:
+        _trace = Trace()
+    if path is not None:
+        import atexit
+        atexit.register(_trace.write, path, format)
+    return _trace
+
+
+def get_trace():
+    return _trace
+
+
+def _caller():
+    # the first frame outside this module, i.e. who touched the name
+    f = sys._getframe(1)
+    while f is not None and f.f_code.co_filename == __file__:
+        f = f.f_back
+    if f is None:
+        return None
+    return f'{f.f_code.co_filename}:{f.f_lineno}'
+
+
+def _run(code, ns, group, staged):
+    # run the code of a group binding its names in 'staged', or bind the
+    # value of a literal table
+    if type(code) is _CodeType:
+        exec(code, ns, staged)
+    else:
+        staged[group[0]] = code
+
+
+def _exec_group(mod, name, store, j, staged):
+    # run the code for group j, return it
+    ns = vars(mod)
+    group = store.groups[j]
+    if _trace is None:
+        code = marshal.loads(store.load(j))
+        _run(code, ns, group, staged)
+    else:
+        t0 = time.perf_counter()
+        code = marshal.loads(store.load(j))
+        t1 = time.perf_counter()
+        _run(code, ns, group, staged)
+        t2 = time.perf_counter()
+        _trace.woke(mod, name, _caller(), t1 - t0, t2 - t1, group)
+    if _woken_by:
+        _note_woken(mod, group, code)
+    return code
 
-def set_class(name):
+
+def _note_woken(mod, names, code):
+    woken = _woken_by.get(get_ident())
+    if woken is not None:
+        woken.append((mod.__name__, names, code))
+
+
+def _find(ns, name):
+    # (store, group) holding lazy 'name' in module dict 'ns', group -1
+    # if none
+    for store in ns.get(LAZY_DATA, ()):
+        j = store.find(name)
+        if j >= 0:
+            return store, j
+    return None, -1
+
+
+def _exec_method(mod, name):
+    # make the function for lazy method 'name', return it and its code
+    ns = vars(mod)
+    store, j = _find(ns, name)
+    if j < 0:
+        raise AttributeError(f'no lazy method {name!r} in module '
+                             f'{mod.__name__!r}')
+    # the def runs at module level, bind it elsewhere
+    local = {}
+    if _trace is None:
+        code = marshal.loads(store.load(j))
+        exec(code, ns, local)
+    else:
+        t0 = time.perf_counter()
+        code = marshal.loads(store.load(j))
+        t1 = time.perf_counter()
+        exec(code, ns, local)
+        t2 = time.perf_counter()
+        _trace.woke(mod, name, _caller(), t1 - t0, t2 - t1)
+    func = local[name.rpartition('.')[2]]
+    func.__qualname__ = name
+    if _woken_by:
+        _note_woken(mod, (name,), code)
+    # the placeholder keeps the function, it is never made again
+    store.release(j)
+    return func, code
+
+
+def _wake_method(placeholder, owner):
+    # (function, code) for the method 'placeholder' stands for, made and
+    # put in its place in the dict of 'owner' or the base holding it.
+    # The code is None if that was done already, e.g. by another thread.
+    mod = placeholder.mod
+    attr = placeholder.name.rpartition('.')[2]
+    with _lock:
+        if placeholder.func is not None:
+            return placeholder.func, None
+        func, code = _exec_method(mod, placeholder.name)
+        placeholder.func = func
+        # 'owner' may be a subclass, e.g. for super()
+        for klass in owner.__mro__:
+            if vars(klass).get(attr) is placeholder:
+                # not setattr(), which a metaclass may hook
+                type.__setattr__(klass, attr, func)
+                break
+        return func, code
+
+
+class LazyMethod:
+    """Placeholder in a class dict for a method whose code is lazy.
+
+    lazy_compile puts one in the body of an eager class for each method
+    it made lazy, 'name' is the 'Class.method' name of the code in the
+    lazy data of module 'module'.  The first lookup makes the function
+    and puts it in the class dict instead, so later lookups cost nothing
+    extra.
+    """
+    __slots__ = ('module', 'name', 'func', 'mod')
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.func = None
+        # the module running the class body, sys.modules may hold
+        # another one by the time the method is used, e.g. after
+        # test.support.import_fresh_module(), or under another name
+        self.mod = sys._getframe(1).f_globals[LAZY_MODULE]
+
+    def __repr__(self):
+        return f'<lazy method {self.module}.{self.name}>'
+
+    def __get__(self, obj, owner=None):
+        if owner is None:
+            owner = type(obj)
+        func = self.func
+        if func is None:
+            func = _wake_method(self, owner)[0]
+        return func.__get__(obj, owner)
+
+
+def _wake(mod, name):
+    # Define lazy 'name' in 'mod', return the code that ran or None if
+    # 'name' is not lazy or another thread woke it first.
+    #
+    # Once a name is woken it is in the module dict and this is never
+    # called for it again, so that fast path needs no locking.  Waking
+    # holds a lock and checks the dict again, so each group runs once
+    # even if many threads hit it at the same time, and all of them see
+    # the same objects.  The lock is re-entrant as waking runs code that
+    # can wake other names, e.g. base classes.  It is one lock for all
+    # modules: those waking across modules, like a class based on one
+    # from a module with a class based on one from the first, would
+    # deadlock with a lock each.
+    #
+    # Globals looked up by the module's own code don't come here, so
+    # the names the group's functions use are woken along with it.
+    # They are plain dict entries afterwards and cost nothing extra.
+    # That runs after the group is defined, so functions calling each
+    # other don't recurse forever.  A ref may be a group still waking its
+    # deps further up, it is left to finish, and refs needing such a
+    # group are woken once the outermost wake is done with the rest.  A
+    # dep can't be, the groups would need each other to be defined
+    # first.
+    #
+    # Other threads read the module dict without the lock, so nothing
+    # goes there before its refs exist: groups run with the staging
+    # dict of the module as locals, which the outermost wake puts in
+    # the module once everything succeeded.  If anything fails the rest
+    # is dropped and the next access tries again.  Class bodies look up
+    # the deps as globals though, so those go in the module before the
+    # group runs, with what was woken for them.  Only a dep whose refs
+    # lead back to a group waking further up is there before all of
+    # them.
+    ns = vars(mod)
+    if '.' in name:
+        # a method of an eager class, see LazyMethod
+        cls_name, _, attr = name.rpartition('.')
+        klass = ns.get(cls_name)
+        placeholder = None
+        if isinstance(klass, type):
+            placeholder = vars(klass).get(attr)
+        if not isinstance(placeholder, LazyMethod):
+            return None
+        return _wake_method(placeholder, klass)[1]
+    store, j = _find(ns, name)
+    if j < 0:
+        return None
+    with _lock:
+        outer = id(ns) not in _staged
+        staged, done, later = _staged.setdefault(id(ns), ({}, [], []))
+        key = (store, j)
+        try:
+            if name in ns or name in staged or store.is_released(j):
+                # woken, or woken and deleted since
+                return None
+            if key in _waking:
+                raise RuntimeError(f'lazy {name!r} of module '
+                                   f'{mod.__name__!r} depends on itself, '
+                                   f'recompile it with a smaller '
+                                   f'--group-max')
+            _waking.add(key)
+            try:
+                # wake base classes etc. first, the code looks them up
+                # as globals which does not go through this hook
+                for dep in store.deps[j]:
+                    if dep in ns:
+                        continue
+                    start, first = len(staged), len(done)
+                    if dep not in staged:
+                        _wake(mod, dep)
+                    _publish(ns, staged, done, start, first)
+                    if dep in staged:
+                        ns.setdefault(dep, staged[dep])
+                # waking them may have defined 'name'
+                if name in staged:
+                    return None
+                code = _exec_group(mod, name, store, j, staged)
+                done.append(key)
+                for ref in store.refs[j]:
+                    if ref in ns or ref in staged:
+                        continue
+                    if _waits(ns, staged, ref, set()):
+                        # once the wakes further up are done
+                        later.append(ref)
+                    else:
+                        _wake(mod, ref)
+            finally:
+                _waking.discard(key)
+            if outer:
+                while later:
+                    ref = later.pop()
+                    if ref not in ns and ref not in staged:
+                        _wake(mod, ref)
+        finally:
+            if outer:
+                del _staged[id(ns)]
+        if outer:
+            _publish(ns, staged, done)
+        return code
+
+
+def _waits(ns, staged, name, seen):
+    # does lazy 'name' need a group still waking further up, through its
+    # deps?
+    store, j = _find(ns, name)
+    if j < 0 or (store, j) in seen:
+        return False
+    if (store, j) in _waking:
+        return True
+    seen.add((store, j))
+    return any(_waits(ns, staged, dep, seen) for dep in store.deps[j]
+               if dep not in ns and dep not in staged)
+
+
+def _publish(ns, staged, done, start=0, first=0):
+    # Put the names staged since the 'start'th in module dict 'ns', and
+    # release the groups done since the 'first'th.  Names already set,
+    # e.g. by monkeypatching, are kept.
+    for n in list(staged)[start:]:
+        ns.setdefault(n, staged[n])
+    for store, j in done[first:]:
+        if _evict_idle is not None:
+            # evicted groups are woken again from their data
+            _track(ns, store, j)
+        else:
+            store.release(j)
+    del done[first:]
+
+
+class Lazy(type(sys)):
+    # Module class giving the __getattr__ hook needed to load functions
+    # as they are accessed.  Shared by all lazy modules.
+    def __getattr__(self, func):
+        #print(f'wake func {func}')
+        if '.' not in func:
+            # 'Class.method' names are woken by LazyMethod
+            _wake(self, func)
+        ns = vars(self)
+        try:
+            return ns[func]
+        except KeyError:
+            pass
+        if id(ns) in _staged:
+            # looked up by code run while waking
+            with _lock:
+                staged = _staged.get(id(ns))
+                if staged is not None and func in staged[0]:
+                    return staged[0][func]
+        raise AttributeError(f'module {self.__name__!r} has no '
+                             f'attribute {func!r}')
+
+    def __dir__(self):
+        # The lazy names are attributes too, e.g. for dir() and help().
+        # 'from m import *' without __all__ reads the module dict though,
+        # it still misses the names not woken yet.
+        names = set(super().__dir__())
+        names.update(name for name in lazy_names(self) if '.' not in name)
+        return sorted(names)
+
+
+def lazy_names(mod):
+    # all lazy names of module 'mod', woken or not
+    names = set()
+    for store in vars(mod).get(LAZY_DATA, ()):
+        names.update(store.names)
+    return names
+
+
+def code_size(code):
+    # estimated memory used by the code objects created by 'code'
+    size = 0
+    if type(code) is not _CodeType:
+        return size # a literal table
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            size += (sys.getsizeof(const) + sys.getsizeof(const.co_consts) +
+                     sys.getsizeof(const.co_names) +
+                     sys.getsizeof(const.co_linetable) +
+                     sys.getsizeof(const.co_exceptiontable) +
+                     code_size(const))
+    return size
+
+
+def _profile_names(paths):
+    # {module name: names} woken in lazy_helper JSON traces
+    import json
+    if isinstance(paths, str):
+        paths = [paths]
+    result = {}
+    for path in paths:
+        with open(path) as fp:
+            trace = json.load(fp)
+        for modname, info in trace['modules'].items():
+            names = result.setdefault(modname, set())
+            names.update(w['name'] for w in info['woken'])
+    return result
+
+
+def _split_name(qualname):
+    # ('module', 'name') for 'module.name', the name may be a method
+    # 'Class.method' of an imported module
+    parts = qualname.split('.')
+    for i in range(len(parts) - 1, 0, -1):
+        modname = '.'.join(parts[:i])
+        if modname in sys.modules:
+            return modname, '.'.join(parts[i:])
+    modname, _, name = qualname.rpartition('.')
+    return modname, name
+
+
+def prewake(modules=None, names=None, profile=None, freeze=False):
+    """Materialize lazy definitions now, e.g. before forking workers.
+
+    By default every lazy name of 'modules' (module names or objects,
+    default all lazy modules imported) is woken.  Otherwise only the
+    'names' given as 'module.name' strings and the names woken in the
+    'profile' trace files written by Trace.write() as JSON.  Modules
+    named there are imported if need be.  If 'freeze' is true,
+    gc.freeze() is called afterwards so the collector does not touch
+    the now shared objects in the children.
+
+    Returns a report dict: the number of 'modules' and 'names' woken,
+    the 'payload_bytes' of marshal data loaded, an estimate of the
+    'code_bytes' of code objects created and a list of 'errors'.  These
+    count the deps and refs woken along, and 'errors' has the names
+    given that are neither lazy nor defined.
+    """
+    import importlib
+    wanted = {}
+    errors = []
+    if names is None and profile is None:
+        if modules is None:
+            modules = [m for m in list(sys.modules.values())
+                       if isinstance(m, Lazy)]
+        for mod in modules:
+            if isinstance(mod, str):
+                mod = sys.modules[mod]
+            wanted[mod.__name__] = lazy_names(mod)
+    else:
+        for qualname in names or ():
+            modname, name = _split_name(qualname)
+            wanted.setdefault(modname, set()).add(name)
+        if profile is not None:
+            for modname, found in _profile_names(profile).items():
+                wanted.setdefault(modname, set()).update(found)
+    report = {'modules': 0, 'names': 0, 'payload_bytes': 0,
+              'code_bytes': 0, 'errors': errors}
+    # what runs in this thread from now on, deps and refs included
+    woken = _woken_by[get_ident()] = []
+    try:
+        for modname in sorted(wanted):
+            try:
+                mod = importlib.import_module(modname)
+            except Exception as e:
+                errors.append(f'{modname}: {e!r}')
+                continue
+            ns = vars(mod)
+            for name in sorted(wanted[modname]):
+                if name in ns:
+                    continue
+                if not isinstance(mod, Lazy) or _find(ns, name)[1] < 0:
+                    errors.append(f'{modname}.{name}: not found')
+                    continue
+                try:
+                    _wake(mod, name)
+                except Exception as e:
+                    errors.append(f'{modname}.{name}: {e!r}')
+    finally:
+        del _woken_by[get_ident()]
+    for modname, names, code in woken:
+        report['names'] += len(names)
+        report['code_bytes'] += code_size(code)
+        report['payload_bytes'] += len(marshal.dumps(code))
+    report['modules'] = len({modname for modname, names, code in woken})
+    if freeze:
+        import gc
+        gc.collect()
+        gc.freeze()
+    return report
+
+
+def resident_payload(modules=None):
+    """Bytes of lazy data 'modules' hold in memory, default all.
+
+    Data is released as names are woken, unless eviction is enabled,
+    see enable_eviction().  Mapped sidecar data not read yet is not
+    counted, it only uses the page cache.
+    """
+    if modules is None:
+        modules = [m for m in list(sys.modules.values())
+                   if isinstance(m, Lazy)]
+    total = 0
+    for mod in modules:
+        if isinstance(mod, str):
+            mod = sys.modules[mod]
+        for store in vars(mod).get(LAZY_DATA, ()):
+            total += store.resident()
+    return total
+
+
+def enable_eviction(idle=600.0, interval=None):
+    """Let lazy functions that go unused be dropped again.
+
+    Groups of functions woken from now on are tracked, evict() drops
+    those woken more than 'idle' seconds ago so they are woken again
+    when next used.  Their lazy data has to be kept for that, it is no
+    longer released once woken.  If 'interval' is given, a daemon thread calls
+    evict() every 'interval' seconds.  Setting LAZY_EVICT to a number of
+    seconds in the environment does the same with interval = idle.
+    """
+    global _evict_idle
+    _evict_idle = idle
+    if interval is not None:
+        import threading
+        def sweep():
+            while True:
+                time.sleep(interval)
+                evict()
+        threading.Thread(target=sweep, name='lazy-evict', daemon=True).start()
+
+
+def _track(ns, store, j):
+    # note group j of 'store' was woken in module dict 'ns'
+    woken = ns.setdefault(LAZY_WOKEN, {})
+    if woken.get((store, j)) in (_EVICTED, _PINNED):
+        # used again after eviction, so it's not cold
+        woken[(store, j)] = _PINNED
+    else:
+        group = store.groups[j]
+        woken[(store, j)] = (time.monotonic(),
+                             {n: ns[n] for n in group if n in ns})
+
+
+def _evict_module(ns, now, idle):
+    # evict() for one module, holding the wake lock
+    woken = ns.get(LAZY_WOKEN)
+    if not woken:
+        return 0
+    # The code of woken groups looks up the names it uses as globals,
+    # which does not wake them, so those have to stay.
+    needed = set()
+    for store in ns[LAZY_DATA]:
+        for j, group in enumerate(store.groups):
+            if any(n in ns for n in group):
+                needed.update(store.deps[j])
+                needed.update(store.refs[j])
+    count = 0
+    for (store, j), state in woken.items():
+        if state in (_EVICTED, _PINNED):
+            continue
+        t, objs = state
+        group = store.groups[j]
+        if now - t < idle or not needed.isdisjoint(group):
+            continue
+        # only plain functions nothing else refers to: the module dict,
+        # 'objs', 'obj' and the getrefcount() argument.  Classes,
+        # values and monkeypatched names stay.
+        for n in group:
+            obj = ns.get(n)
+            if (obj is not objs.get(n) or
+                    type(obj) is not _FunctionType or
+                    sys.getrefcount(obj) > 4):
+                break
+        else:
+            obj = None
+            for n in group:
+                ns.pop(n, None)
+            woken[(store, j)] = _EVICTED
+            count += len(group)
+    return count
+
+
+def evict(idle=None):
+    """Drop lazy functions not used since they were woken.
+
+    Functions woken more than 'idle' seconds ago (default as given to
+    enable_eviction()) are removed from their module, if nothing but
+    the module refers to them, so they can be freed.  Accessing one
+    wakes it again from its marshal data, which is kept, and it is not
+    evicted again.  A group is dropped as a whole and not while code
+    woken from other groups may use it.  Returns the number of names
+    evicted.
+    """
+    if idle is None:
+        idle = _evict_idle
+    if idle is None:
+        return 0
+    now = time.monotonic()
+    count = 0
+    for mod in list(sys.modules.values()):
+        if not isinstance(mod, Lazy):
+            continue
+        ns = vars(mod)
+        with _lock:
+            count += _evict_module(ns, now, idle)
+    return count
+
+
+def set_class(name, inline=None, sidecar=None, zdict=None):
     # Give the module 'name' the __getattr__ hook needed to load
-    # functions as they are accessed.
+    # functions as they are accessed.  'inline' and 'sidecar' are
+    # (names, slots, offsets, groups, deps, refs, data) index tuples, see
+    # Packed, with a stamp instead of data for the sidecar.
+    # 'zdict' is the (path, stamp) of the compression dictionary, the
+    # path relative to the module file.
     #print(f'lazy setup {name}')
     mod = sys.modules[name]
-    class Lazy(type(sys)):
-        def __getattr__(self, func):
-            #print(f'wake func {func}')
-            data = self.__dict__[LAZY_DATA].get(func)
-            if data is not None:
-                code = marshal.loads(data)
-                exec(code, vars(self))
-                return self.__dict__[func]
-            raise AttributeError()
-    sys.modules[name].__class__ = Lazy
+    if zdict is not None:
+        path, stamp = zdict
+        path = os.path.join(os.path.dirname(mod.__file__), path)
+        zdict = (path, ZDICT_MAGIC, stamp)
+    stores = []
+    if inline is not None:
+        stores.append(Packed(*inline, zdict))
+    if sidecar is not None:
+        loader = mod.__spec__.loader
+        if hasattr(loader, 'get_lazy_data'):
+            # the archive is in a bundle
+            stores.append(Sidecar(*sidecar, name, zdict, loader))
+        else:
+            stores.append(Sidecar(*sidecar,
+                                  sidecar_path(mod.__spec__.cached), zdict))
+    ns = mod.__dict__
+    # This runs before any other code of the module but __future__
+    # imports, so other names mostly mean it is reloaded.  Those the old
+    # code defined which are lazy now are dropped, to be woken from the
+    # new data like others are defined again.
+    if any(not key.startswith('__') for key in ns):
+        for store in stores:
+            for n in store.names:
+                ns.pop(n, None)
+        ns.pop(LAZY_WOKEN, None)
+    ns[LAZY_DATA] = tuple(stores)
+    ns[LAZY_MODULE] = mod
+    mod.__class__ = Lazy
+    if _trace is not None:
+        _trace.register(mod, sum(len(store.names) for store in stores))
+
+
+def _lazy_module_class():
+    # Modules made by importlib.util.LazyLoader run their code when any
+    # attribute is looked at, __spec__ included, and the import system
+    # looks at that to check a module in sys.modules is initialized.  So
+    # 'import name' would run it.  This subclass leaves __spec__ alone.
+    global _LazyModule
+    if _LazyModule is None:
+        from importlib.util import _LazyModule as base
+
+        class _LazyModule(base):
+            def __getattribute__(self, attr):
+                if attr == '__spec__':
+                    return object.__getattribute__(self, attr)
+                return base.__getattribute__(self, attr)
+    return _LazyModule
+
+
+def lazy_import(name):
+    # Import module 'name' like importlib.import_module() but defer
+    # running its code, and so the imports it does, until an attribute
+    # is first accessed.  The module is put in sys.modules, so 'import
+    # name' statements bind it too.  A missing module still fails right
+    # away.
+    # Packages above 'name' are imported normally.  Built-in and
+    # extension modules are cheap to import and loaded at once.
+    try:
+        return sys.modules[name]
+    except KeyError:
+        pass
+    import importlib
+    try:
+        from importlib.util import find_spec, module_from_spec, LazyLoader
+    except ImportError:
+        # importlib.util is being imported and runs this, e.g. when the
+        # standard library is compiled with lazy imports
+        return importlib.import_module(name)
+    spec = find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    if (not hasattr(spec.loader, 'exec_module') or
+            spec.origin in (None, 'built-in', 'frozen') or
+            not spec.origin.endswith(('.py', '.pyc'))):
+        return importlib.import_module(name)
+    loader = LazyLoader(spec.loader)
+    spec.loader = loader
+    module = module_from_spec(spec)
+    # another thread may have got there first
+    found = sys.modules.setdefault(name, module)
+    if found is not module:
+        return found
+    loader.exec_module(module)
+    module.__class__ = _lazy_module_class()
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+if os.environ.get('LAZY_TRACE'):
+    enable_trace(os.environ['LAZY_TRACE'])
+if os.environ.get('LAZY_EVICT'):
+    # a bad value is ignored, like for the PYTHON* variables
+    try:
+        _idle = float(os.environ['LAZY_EVICT'])
+    except ValueError:
+        _idle = 0
+    if _idle > 0:
+        enable_eviction(_idle, _idle)
+    del _idle
@@ -1,7 +1,19 @@
+import array
+import importlib
 import importlib.machinery
 import importlib.util
+import marshal
+import mmap
+import os
 import sys
 
+# Compiled lazydb: magic, count, then count + 1 offsets of the records,
+# sorted by module name.  A record is the module name, a NUL byte and
+# the marshalled imports.  Lookups bisect the mmapped file, so opening
+# it costs the same no matter how many modules it has.
+LAZYDB_MAGIC = b'LZB\x01'
+_HEADER = len(LAZYDB_MAGIC) + 4
+
 
 def load_lazydb(infile):
     lazydb = {}
@@ -17,30 +29,208 @@ def load_lazydb(infile):
         except KeyError:
             imports = lazydb[module] = []
 
-        imported, _, name = imported.partition('|')
+        imported, _, name = imported.strip().partition('|')
         modname, _, attr = imported.partition(':')
         imports.append((modname, attr, name))
 
     return lazydb
 
 
+def write_lazydb_index(lazydb, filename):
+    # compile 'lazydb' as returned by load_lazydb() into 'filename'
+    records = [name.encode('utf-8') + b'\0' +
+               marshal.dumps(tuple(map(tuple, lazydb[name])))
+               for name in sorted(lazydb)]
+    offsets = array.array('I', [0])
+    for record in records:
+        offsets.append(offsets[-1] + len(record))
+    start = _HEADER + offsets.itemsize * len(offsets)
+    offsets = array.array('I', [start + off for off in offsets])
+    with open(filename, 'wb') as fp:
+        fp.write(LAZYDB_MAGIC)
+        fp.write(array.array('I', [len(records)]).tobytes())
+        fp.write(offsets.tobytes())
+        fp.write(b''.join(records))
+
+
+class LazyDBIndex:
+    # read-only mapping of module name -> imports over a compiled lazydb
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(LAZYDB_MAGIC)] != LAZYDB_MAGIC:
+            raise ValueError(f'{filename!r} is not a compiled lazydb')
+        view = memoryview(self.data)
+        count = view[len(LAZYDB_MAGIC):_HEADER].cast('I')[0]
+        self.offsets = view[_HEADER:_HEADER + 4 * (count + 1)].cast('I')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _key(self, i):
+        start = self.offsets[i]
+        return self.data[start:self.data.find(b'\0', start)]
+
+    def get(self, name, default=None):
+        key = name.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self) or self._key(lo) != key:
+            return default
+        start = self.offsets[lo] + len(key) + 1
+        return marshal.loads(self.data[start:self.offsets[lo + 1]])
+
+
+def open_lazydb(filename):
+    # the lazydb in 'filename', compiled or text
+    with open(filename, 'rb') as fp:
+        compiled = fp.read(len(LAZYDB_MAGIC)) == LAZYDB_MAGIC
+    if compiled:
+        return LazyDBIndex(filename)
+    with open(filename) as infile:
+        return load_lazydb(infile)
+
+
 def install(filename):
     try:
-        infile = open(filename)
+        lazydb = open_lazydb(filename)
     except FileNotFoundError:
         return
 
-    with infile:
-        lazydb = load_lazydb(infile)
+    # Finders are made per path entry by sys.path_hooks, ours goes in
+    # front of the standard FileFinder hook.  Finders already cached
+    # for sys.path entries are dropped so they are made again.
+    bootstrap = importlib._bootstrap_external
+    loader_details = bootstrap._get_supported_file_loaders()
+    hook = LazyFileFinder.path_hook(*loader_details, lazydb=lazydb)
+    for i, other in enumerate(sys.path_hooks):
+        if 'FileFinder' in getattr(other, '__qualname__', ''):
+            break
+    else:
+        i = len(sys.path_hooks)
+    sys.path_hooks.insert(i, hook)
+    sys.path_importer_cache.clear()
+    return hook
+
+
+# Bundle: magic, the size of the index, the marshalled index
+# {module name: (is package, code offset, code size, sidecar offset,
+# sidecar size)} and the data, offsets counting from the end of the
+# index.  The whole file is mapped once, imports from it don't stat,
+# open or read anything.
+BUNDLE_MAGIC = b'LZA\x01'
+
+
+def write_bundle(filename, modules):
+    # write 'modules', {name: (is package, marshalled code, sidecar
+    # archive or None)}, as a bundle to 'filename'
+    index = {}
+    data = []
+    offset = 0
+    for name, (is_package, code, sidecar) in sorted(modules.items()):
+        sidecar = sidecar or b''
+        index[name] = (is_package, offset, len(code),
+                       offset + len(code), len(sidecar))
+        data += [code, sidecar]
+        offset += len(code) + len(sidecar)
+    index = marshal.dumps(index)
+    with open(filename, 'wb') as fp:
+        fp.write(BUNDLE_MAGIC)
+        fp.write(array.array('I', [len(index)]).tobytes())
+        fp.write(index)
+        fp.write(b''.join(data))
 
-    for i, finder in enumerate(sys.meta_path):
-        if type(finder) is importlib.machinery.FileFinder:
+
+def install_bundle(filename):
+    # serve the modules in bundle 'filename' ahead of sys.path
+    finder = BundleFinder(filename)
+    for i, other in enumerate(sys.meta_path):
+        if other is importlib.machinery.PathFinder:
             break
     else:
-        return
+        i = len(sys.meta_path)
+    sys.meta_path.insert(i, finder)
+    return finder
+
 
-    finder = LazyFileFinder(finder.path, *finder._loaders, lazydb)
-    sys.meta_path[i] = finder
+class BundleFinder:
+    # Finder and loader for the modules in a bundle.  Module files are
+    # named as if the bundle were a directory, like zipimport does.
+
+    def __init__(self, filename):
+        self.path = os.path.abspath(filename)
+        with open(filename, 'rb') as fp:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            raise ValueError(f'{filename!r} is not a lazy bundle')
+        self.view = memoryview(self.data)
+        size = self.view[len(BUNDLE_MAGIC):_HEADER].cast('I')[0]
+        self.index = marshal.loads(self.view[_HEADER:_HEADER + size])
+        self.base = _HEADER + size
+
+    def __repr__(self):
+        return f'<BundleFinder {self.path!r}>'
+
+    def _entry(self, fullname):
+        try:
+            return self.index[fullname]
+        except KeyError:
+            raise ImportError(f'{fullname!r} is not in the bundle',
+                              name=fullname) from None
+
+    def find_spec(self, fullname, path=None, target=None):
+        entry = self.index.get(fullname)
+        if entry is None:
+            return None
+        is_package = entry[0]
+        parts = fullname.split('.')
+        spec = importlib.machinery.ModuleSpec(fullname, self,
+                                              is_package=is_package)
+        if is_package:
+            location = os.path.join(self.path, *parts)
+            spec.submodule_search_locations = [location]
+            spec.origin = os.path.join(location, '__init__.py')
+        else:
+            spec.origin = os.path.join(self.path, *parts) + '.py'
+        spec.has_location = True
+        return spec
+
+    def invalidate_caches(self):
+        pass
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        code = self.get_code(module.__spec__.name)
+        exec(code, module.__dict__)
+
+    def is_package(self, fullname):
+        return self._entry(fullname)[0]
+
+    def get_code(self, fullname):
+        _, start, size, _, _ = self._entry(fullname)
+        start += self.base
+        return marshal.loads(self.view[start:start + size])
+
+    def get_source(self, fullname):
+        return None
+
+    def get_lazy_data(self, fullname):
+        # the sidecar archive of 'fullname', for lazy_helper
+        _, _, _, start, size = self._entry(fullname)
+        start += self.base
+        return self.view[start:start + size]
+
+    def get_lazy_offset(self, fullname):
+        # where get_lazy_data() starts in the mapping
+        return self.base + self._entry(fullname)[3]
 
 
 class LazyFileFinder(importlib.machinery.FileFinder):
@@ -49,29 +239,70 @@ class LazyFileFinder(importlib.machinery.FileFinder):
         super().__init__(path, *loader_details)
         self.lazydb = lazydb
 
+    @classmethod
+    def path_hook(cls, *loader_details, lazydb):
+        def path_hook_for_LazyFileFinder(path):
+            if not os.path.isdir(path or '.'):
+                raise ImportError('only directories are supported',
+                                  path=path)
+            return cls(path, *loader_details, lazydb=lazydb)
+        return path_hook_for_LazyFileFinder
+
     def find_spec(self, fullname, target=None):
         spec = super().find_spec(fullname, target)
-        if spec is None:
-            return None
+        if spec is None or spec.loader is None:
+            return spec
 
         lazy = self.lazydb.get(fullname)
         if lazy:
-            spec.loader = importlib.util.LazyLoader.factory(spec.loader)
+            spec.loader = LazyFileLoader(spec.loader)
             spec.loader_state = {
                     'imports': lazy,
                     }
         return spec
 
 
-class LazyFileLoader(importlib.util.LazyLoader):
+class LazyFileLoader:
+    # Wraps the loader of a module found in the lazydb.  Before its code
+    # runs, the modules it imports are put in sys.modules as lazy
+    # modules, so its own import statements bind them without running
+    # them.  Anything else is up to the wrapped loader.
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
 
     def exec_module(self, module):
+        import lazy_helper
         imports = module.__spec__.loader_state.get('imports')
         for modname, attr, name in imports or ():
-            imported = importlib.import_module(modname, module.__package__)
             if attr:
+                # 'from modname import attr' needs the module now
+                imported = importlib.import_module(modname,
+                                                   module.__package__)
                 setattr(module, name or attr, getattr(imported, attr))
             else:
-                setattr(module, name or modname, imported)
+                try:
+                    lazy_helper.lazy_import(modname)
+                except ImportError:
+                    pass # left for the module's import to report
+
+        self.loader.exec_module(module)
+
+
+def main():
+    # compile a text lazydb: lazyfilefinder.py INFILE OUTFILE
+    if len(sys.argv) != 3:
+        sys.exit('usage: lazyfilefinder.py INFILE OUTFILE')
+    with open(sys.argv[1]) as infile:
+        lazydb = load_lazydb(infile)
+    write_lazydb_index(lazydb, sys.argv[2])
+
 
-        super().exec_module(module)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+import os
+import importlib
+import sys
+import shutil
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+
+import lazy_compile
+import lazy_helper
+
+
+class LazyModuleTests(unittest.TestCase):
+    # Each test compiles its modules into a fresh directory with the
+    # given group size and imports them from there.
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        sys.path.insert(0, self.dir)
+        self.addCleanup(sys.path.remove, self.dir)
+        options = lazy_compile._get_options()
+        self.addCleanup(lazy_compile._set_options, options)
+        self.trace = lazy_helper.enable_trace()
+
+    def compile_module(self, name, source, group_max=16):
+        with open(os.path.join(self.dir, name + '.py'), 'w') as fp:
+            fp.write(textwrap.dedent(source))
+        lazy_compile.OPTIONS.group_max = group_max
+        ok = lazy_compile.compile_dir(self.dir, force=True, quiet=2)
+        self.assertTrue(ok)
+
+    def make_module(self, name, source, group_max=16):
+        self.compile_module(name, source, group_max)
+        sys.modules.pop(name, None)
+        self.addCleanup(sys.modules.pop, name, None)
+        __import__(name)
+        mod = sys.modules[name]
+        self.assertTrue(lazy_helper.lazy_names(mod))
+        return mod
+
+    def test_groups_without_cycles(self):
+        # Kind and X in one group would depend on Param which depends on
+        # X again
+        mod = self.make_module('lazy_cycle', '''\
+            class Kind:
+                A = 1
+                def make(self):
+                    return Param()
+            X = Kind
+            class Param:
+                default = X
+            ''', group_max=2)
+        self.assertIs(mod.Kind().make().default, mod.Kind)
+
+    def test_refs_of_waking_group(self):
+        # Conv needs Mixin first, whose refs wake Conv again
+        mod = self.make_module('lazy_refs', '''\
+            class Mixin:
+                def convert(self):
+                    return Conv()
+            class Conv(Mixin):
+                pass
+            ''', group_max=1)
+        self.assertIsInstance(mod.Conv().convert(), mod.Conv)
+        self.assertIsInstance(mod.Mixin().convert(), mod.Conv)
+
+    def test_reload(self):
+        # a module compiled again and reloaded uses the new archive, even
+        # for names woken before
+        lazy_compile.OPTIONS.sidecar = True
+        source = '''\
+            def f():
+                return {0}
+            def g():
+                return {0}
+            '''
+        mod = self.make_module('lazy_reload', source.format(1))
+        self.assertEqual(mod.f(), 1)
+        self.compile_module('lazy_reload', source.format(2))
+        importlib.reload(mod)
+        self.assertEqual((mod.f(), mod.g()), (2, 2))
+
+    def test_global_names(self):
+        # a function binding X with 'global' runs before the other one
+        # using X is woken
+        mod = self.make_module('lazy_global', '''\
+            X = None
+            def start(v):
+                global X
+                X = v
+            def stop():
+                global X
+                old, X = X, None
+                return old
+            ''')
+        mod.start(5)
+        self.assertEqual(mod.stop(), 5)
+
+    def test_method_defaults(self):
+        # a lazy method made later would see DEFAULT changed
+        lazy_compile.OPTIONS.lazy_methods = True
+        mod = self.make_module('lazy_default', '''\
+            DEFAULT = 1
+            class C:
+                def m(self, x=DEFAULT):
+                    return x
+                def n(self):
+                    return DEFAULT
+            DEFAULT = 2
+            ''')
+        self.assertEqual(mod.C().m(), 1)
+        self.assertIn('C.n', lazy_helper.lazy_names(mod))
+
+    def test_base_init_calls(self):
+        # calling a method through its class does not change the class
+        mod = self.make_module('lazy_init', '''\
+            class Base:
+                def __init__(self):
+                    self.x = 1
+            class Error(ValueError, Base):
+                def __init__(self, msg):
+                    ValueError.__init__(self, msg)
+                    Base.__init__(self)
+            ''')
+        self.assertLessEqual({'Base', 'Error'}, lazy_helper.lazy_names(mod))
+        self.assertEqual(mod.Error('no').x, 1)
+
+    def test_methods_of_module_copies(self):
+        # each copy of a module makes the methods from its own data
+        lazy_compile.OPTIONS.lazy_methods = True
+        first = self.make_module('lazy_copies', '''\
+            class C:
+                def m(self):
+                    return 1
+            C.eager = True
+            ''')
+        self.assertEqual(first.C().m(), 1)
+        sys.modules.pop('lazy_copies')
+        second = importlib.import_module('lazy_copies')
+        sys.modules['lazy_copies'] = first
+        self.assertEqual(second.C().m(), 1)
+
+    def test_methods_of_renamed_module(self):
+        # like _pydecimal, which calls itself decimal
+        lazy_compile.OPTIONS.lazy_methods = True
+        mod = self.make_module('lazy_renamed', '''\
+            __name__ = 'lazy_alias'
+            class C:
+                def m(self):
+                    return 1
+            C.eager = True
+            ''')
+        self.assertEqual(mod.C().m(), 1)
+
+    def test_module_attrs(self):
+        # __name__ is in the module dict already, nothing would wake it
+        mod = self.make_module('lazy_attrs', '''\
+            __name__ = 'lazy_alias'
+            class C:
+                pass
+            ''')
+        self.assertEqual(mod.C.__module__, 'lazy_alias')
+
+    def test_dir(self):
+        mod = self.make_module('lazy_dir', '''\
+            def f():
+                pass
+            ''')
+        self.assertIn('f', dir(mod))
+        self.assertNotIn('f', vars(mod))
+
+    def test_star_import(self):
+        # the names a star import may replace keep their order
+        self.compile_module('lazy_fast', '''\
+            __all__ = ['f']
+            def f():
+                return 'fast'
+            ''')
+        self.compile_module('lazy_star', '''\
+            def f():
+                return 'python'
+            from lazy_fast import *
+            g = f
+            ''')
+        for name in ('lazy_fast', 'lazy_star'):
+            sys.modules.pop(name, None)
+            self.addCleanup(sys.modules.pop, name, None)
+        import lazy_star
+        self.assertEqual(lazy_star.g(), 'fast')
+
+    def test_attribute_values(self):
+        # an attribute is looked up at import, it may change since
+        stdout = sys.stdout
+        mod = self.make_module('lazy_attr', '''\
+            import sys
+            saved = sys.stdout
+            def get():
+                return saved
+            ''')
+        self.addCleanup(setattr, sys, 'stdout', stdout)
+        sys.stdout = None
+        self.assertIs(mod.get(), stdout)
+
+    def test_imports_for_side_effects(self):
+        # an import whose name nothing uses runs at once
+        lazy_compile.OPTIONS.lazy_imports = True
+        self.compile_module('lazy_effect', 'X = 1\n')
+        self.compile_module('lazy_used', 'X = 2\n')
+        for name in ('lazy_effect', 'lazy_used'):
+            sys.modules.pop(name, None)
+            self.addCleanup(sys.modules.pop, name, None)
+        mod = self.make_module('lazy_importer', '''\
+            import lazy_effect
+            import lazy_used
+            def f():
+                return lazy_used.X
+            ''')
+        deferred = lazy_helper._lazy_module_class()
+        self.assertNotIsInstance(sys.modules['lazy_effect'], deferred)
+        self.assertIsInstance(sys.modules['lazy_used'], deferred)
+        self.assertEqual(mod.f(), 2)
+
+    def test_refs_before_names(self):
+        # a thread calling a function as soon as it is in the module dict
+        # finds what it uses there too
+        source = '''\
+            def f():
+                return len(TABLE)
+            TABLE = {}
+            '''.format(tuple(range(20000)))
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        mod = self.make_module('lazy_staged', source)
+        for round in range(5):
+            sys.modules.pop('lazy_staged')
+            mod = importlib.import_module('lazy_staged')
+            ns = vars(mod)
+            results = []
+            def call():
+                while 'f' not in ns:
+                    time.sleep(0)
+                try:
+                    results.append(ns['f']())
+                except BaseException as e:
+                    results.append(e)
+            t = threading.Thread(target=call)
+            t.start()
+            mod.f
+            t.join()
+            self.assertEqual(results, [20000])
+
+    def test_wake_across_modules(self):
+        # each module's f needs the other module woken while it holds
+        # the lock, and waking TABLE first leaves time for the other
+        # thread to start too
+        source = '''\
+            import {}
+            TABLE = {}
+            def f(x: {}.g) -> TABLE:
+                return x
+            def g():
+                pass
+            '''
+        table = tuple(range(20000))
+        self.compile_module('lazy_xa', source.format('lazy_xb', table,
+                                                     'lazy_xb'))
+        self.compile_module('lazy_xb', source.format('lazy_xa', table,
+                                                     'lazy_xa'))
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        for name in ('lazy_xa', 'lazy_xb'):
+            self.addCleanup(sys.modules.pop, name, None)
+        for round in range(5):
+            for name in ('lazy_xa', 'lazy_xb'):
+                sys.modules.pop(name, None)
+            import lazy_xa, lazy_xb
+            threads = [threading.Thread(target=getattr, args=(mod, 'f'),
+                                        daemon=True)
+                       for mod in (lazy_xa, lazy_xb)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(10)
+            self.assertFalse(any(t.is_alive() for t in threads))
+            self.assertIs(lazy_xa.f.__annotations__['x'], lazy_xb.g)
+
+    def test_evict(self):
+        # only functions nothing else uses go, and those used again stay
+        self.addCleanup(setattr, lazy_helper, '_evict_idle', None)
+        lazy_helper.enable_eviction()
+        mod = self.make_module('lazy_evict', '''\
+            def f():
+                return g()
+            def g():
+                return 1
+            def h():
+                return 2
+            ''', group_max=1)
+        ns = vars(mod)
+        held = mod.h
+        self.assertEqual(mod.f(), 1)
+        lazy_helper.evict(0)
+        # g is used by f which was woken
+        self.assertEqual(('f' in ns, 'g' in ns, 'h' in ns),
+                         (False, True, True))
+        lazy_helper.evict(0)
+        self.assertNotIn('g', ns)
+        self.assertEqual(mod.f(), 1)
+        lazy_helper.evict(0)
+        # woken again, it is not cold
+        self.assertIn('f', ns)
+        self.assertIs(mod.h, held)
+
+    def test_threads(self):
+        # many threads touching overlapping names, groups, deps and refs
+        # all see the same objects and each group runs once
+        source = '''\
+            class Base:
+                def peer(self):
+                    return Peer
+            class Peer(Base):
+                def other(self):
+                    return Other
+            class Other(Peer):
+                pass
+            def make():
+                return Other(), Peer()
+            LIMIT = 3
+            def clamp(x, hi=LIMIT):
+                return min(x, hi)
+            class Last(Other, Base):
+                pass
+            '''
+        names = ['Base', 'Peer', 'Other', 'make', 'clamp', 'Last', 'LIMIT']
+        for group_max in (1, 2, 16):
+            for round in range(20):
+                name = 'lazy_threads'
+                if round == 0:
+                    mod = self.make_module(name, source, group_max)
+                else:
+                    sys.modules.pop(name)
+                    __import__(name)
+                    mod = sys.modules[name]
+                barrier = threading.Barrier(8)
+                results = []
+                errors = []
+                def run(i):
+                    try:
+                        barrier.wait()
+                        order = names[i:] + names[:i]
+                        results.append({n: getattr(mod, n) for n in order})
+                        mod.make()
+                    except BaseException as e:
+                        errors.append(e)
+                interval = sys.getswitchinterval()
+                sys.setswitchinterval(1e-6)
+                try:
+                    threads = [threading.Thread(target=run, args=(i % 7,))
+                               for i in range(8)]
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                finally:
+                    sys.setswitchinterval(interval)
+                self.assertEqual(errors, [])
+                self.assertEqual(len(results), 8)
+                for r in results:
+                    for n in names:
+                        self.assertIs(r[n], results[0][n])
+                self.assertEqual(mod.clamp(5), 3)
+                self.assertTrue(issubclass(mod.Last, mod.Base))
+                woken = [w['name'] for w in
+                         self.trace.modules[name]['woken']]
+                self.assertEqual(len(woken), len(set(woken)))
+                groups = [{w['name']} | set(w['group']) for w in
+                          self.trace.modules[name]['woken']]
+                self.assertEqual(sum(len(g) for g in groups),
+                                 len(set().union(*groups)))
+
+
+if __name__ == '__main__':
+    unittest.main()